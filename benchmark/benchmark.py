@@ -0,0 +1,282 @@
+"""Benchmark the exporter against the synthetic Dashboard API at several scales.
+
+For every scale it starts the mock API with a synthetic organization and the
+exporter against it, then records the wall and CPU time of the first full
+collection cycle, the API calls it took, the exporter's peak RSS, and the
+latency and size of a scrape. The report is written as JSON; given a baseline report it
+exits non-zero when any scale regressed by more than the tolerance.
+
+    python benchmark/benchmark.py --scales 100x500,1000x5000 --output report.json
+    python benchmark/benchmark.py --baseline report.json
+
+With ``--replay`` it serves a recording made with the exporter's ``--record``
+through ``mock_api/replay_server.py`` instead, to benchmark against a real
+organization's data.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXPORTER = os.path.join(ROOT, "meraki_api_exporter.py")
+MOCK_API = os.path.join(ROOT, "mock_api", "mock_api.py")
+REPLAY_SERVER = os.path.join(ROOT, "mock_api", "replay_server.py")
+SOURCES = {"networks", "devices", "uplinks_loss_and_latency", "uplink_statuses", "uplink_usage"}
+# Lower is better for all of them; a result is a regression when it grows past the tolerance.
+COMPARED = [
+    "first_cycle_seconds",
+    "first_cycle_cpu_seconds",
+    "api_calls",
+    "peak_rss_bytes",
+    "scrape_p50_seconds",
+]
+
+
+def wait_for(url, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return requests.get(url, timeout=5)
+        except requests.exceptions.ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def peak_rss(pid):
+    """Peak resident set size of ``pid`` in bytes, from Linux's VmHWM."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def cpu_time(pid):
+    """User plus system CPU seconds ``pid`` has used so far, from Linux's /proc/PID/stat."""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # Fields after the parenthesised command name; utime and stime are the 12th and 13th.
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def samples(text, name):
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            if sample.name == name:
+                yield sample
+
+
+def api_command(networks, devices, args):
+    if args.replay:
+        return [
+            sys.executable,
+            REPLAY_SERVER,
+            *args.replay,
+            "--port", str(args.mock_port),
+            "--speed", str(args.replay_speed),
+        ]
+    return [
+        sys.executable,
+        MOCK_API,
+        "--port", str(args.mock_port),
+        "--networks", str(networks),
+        "--devices", str(devices),
+        "--latency", str(args.latency),
+        "--rate-limit-probability", str(args.rate_limit_probability),
+        "--page-size", str(args.page_size),
+    ]
+
+
+def run_scale(networks, devices, args):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    metrics_url = f"http://127.0.0.1:{args.exporter_port}/"
+    mock = subprocess.Popen(
+        api_command(networks, devices, args),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    exporter = None
+    try:
+        wait_for(mock_url, args.timeout)
+        # The synthetic organization is 1234; a replayed one is whichever was recorded.
+        organization_id = requests.get(f"{mock_url}/api/v1/organizations").json()[0]["id"]
+        start = time.monotonic()
+        exporter = subprocess.Popen(
+            [
+                sys.executable,
+                EXPORTER,
+                "-k", "benchmark",
+                "-o", organization_id,
+                "-i", "127.0.0.1",
+                "-p", str(args.exporter_port),
+                "-m", f"{mock_url}/api/v1",
+                *args.exporter_args,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        while True:
+            if time.monotonic() - start > args.timeout:
+                raise TimeoutError(f"{networks}x{devices}: first cycle took over {args.timeout}s")
+            try:
+                text = requests.get(metrics_url, timeout=10).text
+            except requests.exceptions.ConnectionError:
+                time.sleep(0.1)
+                continue
+            done = {
+                sample.labels["source"]
+                for sample in samples(text, "meraki_exporter_source_last_success_timestamp_seconds")
+            }
+            if SOURCES <= done:
+                break
+            time.sleep(0.1)
+        first_cycle = time.monotonic() - start
+        first_cycle_cpu = cpu_time(exporter.pid)
+
+        latencies = []
+        for _ in range(args.scrapes):
+            scrape_start = time.monotonic()
+            body = requests.get(metrics_url, headers={"Accept-Encoding": "identity"}).content
+            latencies.append(time.monotonic() - scrape_start)
+        text = body.decode()
+        stats = requests.get(f"{mock_url}/_stats").json()
+        phases = {}
+        for sample in samples(text, "meraki_exporter_phase_duration_seconds_sum"):
+            phase = sample.labels["phase"]
+            phases[phase] = phases.get(phase, 0.0) + sample.value
+
+        return {
+            "networks": networks,
+            "devices": devices,
+            "first_cycle_seconds": round(first_cycle, 3),
+            "first_cycle_cpu_seconds": first_cycle_cpu,
+            "api_calls": stats["total"],
+            "api_rate_limited": stats["rate_limited"],
+            "peak_rss_bytes": peak_rss(exporter.pid),
+            "scrape_p50_seconds": round(statistics.median(latencies), 5),
+            "scrape_p95_seconds": round(
+                statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0], 5
+            ),
+            "scrape_bytes": len(body),
+            "series": sum(1 for line in text.splitlines() if line and not line.startswith("#")),
+            "phase_seconds": {phase: round(value, 4) for phase, value in sorted(phases.items())},
+        }
+    finally:
+        for process in (exporter, mock):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+
+def regressions(results, baseline, tolerance):
+    baseline = {(r["networks"], r["devices"]): r for r in baseline["results"]}
+    found = []
+    for result in results:
+        previous = baseline.get((result["networks"], result["devices"]))
+        if previous is None:
+            continue
+        for key in COMPARED:
+            if result.get(key) is None or not previous.get(key):
+                continue
+            change = result[key] / previous[key] - 1
+            if change > tolerance:
+                found.append(
+                    f"{result['networks']}x{result['devices']} {key}: "
+                    f"{previous[key]} -> {result[key]} (+{change:.0%})"
+                )
+    return found
+
+
+def parse_scales(value):
+    scales = []
+    for scale in value.split(","):
+        networks, devices = scale.split("x")
+        scales.append((int(networks), int(devices)))
+    return scales
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scales",
+        type=parse_scales,
+        default=parse_scales("100x500,1000x5000,10000x50000"),
+        help="Comma separated NETWORKSxDEVICES organization sizes",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction a result may grow over the baseline before it is a regression",
+    )
+    parser.add_argument("--scrapes", type=int, default=20, help="Scrapes timed per scale")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds allowed for a first cycle")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock adds to every request")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument(
+        "--replay",
+        nargs="+",
+        metavar="RECORDING",
+        help="Serve these recordings (files or directories) instead of synthetic organizations",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=0.0,
+        help="Divide recorded response times by this, 0 (the default) for no delay",
+    )
+    parser.add_argument("--mock-port", type=int, default=9833)
+    parser.add_argument("--exporter-port", type=int, default=9832)
+    parser.add_argument(
+        "exporter_args",
+        nargs=argparse.REMAINDER,
+        help="Further exporter options, after --",
+    )
+    args = parser.parse_args()
+    if args.exporter_args[:1] == ["--"]:
+        args.exporter_args = args.exporter_args[1:]
+
+    if args.replay:
+        # One run against the recording, reported and compared as a scale of its own.
+        args.scales = [(None, None)]
+
+    results = []
+    for networks, devices in args.scales:
+        result = run_scale(networks, devices, args)
+        print(json.dumps(result), flush=True)
+        results.append(result)
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "exporter_args": args.exporter_args,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            found = regressions(results, json.load(baseline), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if found else 0)
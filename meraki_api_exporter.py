@@ -1,274 +1,2599 @@
+import asyncio
+import calendar
+import concurrent.futures
+import cProfile
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import logging
+import math
+import os
+import pickle
+import pstats
+import random
+import re
+import sys
+import threading
 import time
+import tracemalloc
+import urllib.parse
+import zlib
+from collections import namedtuple
+from typing import Optional, TypedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import aiohttp
 import configargparse
-import meraki
-from prometheus_client import Gauge, start_http_server
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.samples import Sample
+from prometheus_client.exposition import gzip_accepted
+from prometheus_client.openmetrics.exposition import (
+    CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE_LATEST,
+    generate_latest as generate_openmetrics,
+)
+
+try:
+    import numpy
+except ImportError:  # Optional, loss and latency window statistics are then computed in Python
+    numpy = None
+
+try:
+    import msgspec
+except ImportError:  # Optional, the built-in client then decodes with orjson or json
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class DashboardAPIError(Exception):
+    """A Dashboard API request of the built-in client failed for good."""
+
+    def __init__(self, operation, status, reason, message=None):
+        super().__init__(f"{operation} - {status} {reason}, {message}")
+        self.operation = operation
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+
+# The meraki SDK is only imported when it is the client in use, see import_sdk.
+API_ERRORS = (DashboardAPIError,)
+
+
+def intern_label(value):
+    """Intern label strings, so the many series sharing a label value share one string."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+# Each API result is reduced to a tuple of the fields the exporter uses as
+# soon as it arrives; everything else is dropped.
+
+
+def project_network(network):
+    product_types = network.get("productTypes")
+    return (
+        intern_label(network.get("id")),
+        intern_label(network.get("name")),
+        tuple(map(intern_label, product_types)) if product_types is not None else None,
+    )
+
+
+def project_device(device):
+    product_type = device.get("productType")
+    if product_type is None and (device.get("model") or "").startswith(("MX", "Z")):
+        product_type = "appliance"
+    return (
+        intern_label(device.get("serial")),
+        intern_label(device.get("networkId")),
+        intern_label(device.get("name") or device.get("mac")),
+        intern_label(device.get("status")),
+        device.get("usingCellularFailover"),
+        intern_label(product_type),
+    )
+
+
+def parse_timestamp(value):
+    """Unix time of a Dashboard API timestamp such as 2019-01-31T18:46:13Z."""
+    return calendar.timegm(time.strptime(value, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def sample_timestamp(sample):
+    return parse_timestamp(sample["ts"])
+
+
+def latest_sample(time_series, field):
+    """The latest value of ``field`` in ``time_series`` that is not null, and its timestamp when exported."""
+    for sample in reversed(time_series):
+        if sample.get(field) is not None:
+            timestamp = sample_timestamp(sample) if LOSS_AND_LATENCY_TIMESTAMPS else None
+            return sample[field], timestamp
+    return None, None
+
+
+WINDOW_STATS = ("min", "max", "mean", "p95")
+# A failed refresh is retried after RETRY_DELAY, doubling with every failure in
+# a row: up to the source's interval, and once BREAKER_THRESHOLD failures open
+# its circuit, up to BREAKER_MAX_BACKOFF.
+RETRY_DELAY = 5
+BREAKER_THRESHOLD = 3
+BREAKER_MAX_BACKOFF = 3600
+# The least time between refreshes of a source asked for before its interval is up.
+EARLY_REFRESH_INTERVAL = 60
+
+
+def sample_values(time_series, field):
+    """The values of ``field`` in ``time_series`` as floats, with NaN for nulls."""
+    values = []
+    for sample in time_series:
+        value = sample.get(field)
+        values.append(math.nan if value is None else float(value))
+    return values
+
 
+def window_stats(rows):
+    """The WINDOW_STATS of each row of samples, skipping NaN; None for a row without samples.
 
-def get_networks(network_devices_dict, dashboard, organization_id):
+    With NumPy the rows are padded into one array that is sorted and reduced
+    for all rows at once; otherwise each row is reduced in Python.
+    """
+    if numpy is None:
+        return [python_window_stats(row) for row in rows]
+    width = max(map(len, rows), default=0)
+    if width == 0:
+        return [None] * len(rows)
+    # Sorting moves NaN to the end of each row, so the first ``count`` columns
+    # of a row are its samples in order.
+    padded = (row + [math.nan] * (width - len(row)) for row in rows)
+    samples = numpy.fromiter(
+        itertools.chain.from_iterable(padded), float, len(rows) * width
+    ).reshape(len(rows), width)
+    samples.sort(axis=1)
+    count = numpy.count_nonzero(~numpy.isnan(samples), axis=1)
+    last = numpy.maximum(count, 1) - 1
+    # Linear interpolation between closest ranks, as numpy.percentile does.
+    rank = last * 0.95
+    lower = rank.astype(int)
+    upper = numpy.minimum(lower + 1, last)
+    below = numpy.take_along_axis(samples, lower[:, None], axis=1)[:, 0]
+    above = numpy.take_along_axis(samples, upper[:, None], axis=1)[:, 0]
+    stats = numpy.stack(
+        [
+            samples[:, 0],
+            numpy.take_along_axis(samples, last[:, None], axis=1)[:, 0],
+            numpy.nansum(samples, axis=1) / numpy.maximum(count, 1),
+            below + (above - below) * (rank - lower),
+        ],
+        axis=1,
+    )
+    return [tuple(row) if present else None for row, present in zip(stats.tolist(), count > 0)]
+
+
+def python_window_stats(row):
+    values = sorted(value for value in row if not math.isnan(value))
+    if not values:
+        return None
+    # Linear interpolation between closest ranks, as numpy.percentile does.
+    rank = (len(values) - 1) * 0.95
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    p95 = values[lower] + (values[upper] - values[lower]) * (rank - lower)
+    return values[0], values[-1], sum(values) / len(values), p95
+
+
+def project_uplink_loss_and_latency(uplink, latency_stats=None, loss_stats=None):
+    time_series = uplink.get("timeSeries") or []
+    latency, latency_timestamp = latest_sample(time_series, "latencyMs")
+    loss, loss_timestamp = latest_sample(time_series, "lossPercent")
+    return (
+        uplink.get("networkId"),
+        uplink.get("serial"),
+        intern_label(uplink.get("uplink")),
+        latency / 1000 if latency is not None else None,
+        latency_timestamp,
+        loss,
+        loss_timestamp,
+        tuple(value / 1000 for value in latency_stats) if latency_stats else None,
+        loss_stats,
+    )
+
+
+def project_uplink_statuses(device):
+    return [
+        (
+            device.get("networkId"),
+            device.get("serial"),
+            intern_label(uplink.get("interface")),
+            intern_label(uplink.get("status")),
+        )
+        for uplink in device.get("uplinks", [])
+    ]
+
+
+def in_shard(network_id):
+    """Whether this replica exports ``network_id``.
+
+    Networks are assigned to shards by a stable hash of their ID, so a
+    network only moves to another replica when ``--shard-count`` changes.
+    """
+    if SHARD_COUNT == 1:
+        return True
+    return network_id is not None and zlib.crc32(network_id.encode()) % SHARD_COUNT == SHARD_INDEX
+
+
+async def collect_pages(pages, reduce, network_key="networkId"):
+    """Consume a paginated call page by page, keeping only ``reduce(item)`` of every item in the shard.
+
+    The client is created with ``use_iterator_for_get_pages``, so it yields the
+    items of each page as it arrives and lets the page go once they are
+    consumed; the full raw result is never held in memory at once.
+    """
+    return [reduce(item) async for item in pages if in_shard(item.get(network_key))]
+
+
+async def collect_flat_pages(pages, reduce):
+    """Like ``collect_pages``, for a ``reduce`` that returns several records per item."""
+    return [
+        record
+        async for item in pages
+        if in_shard(item.get("networkId"))
+        for record in reduce(item)
+    ]
+
+
+async def get_networks(dashboard, organization_id):
     try:
-        networks = dashboard.organizations.getOrganizationNetworks(
-            organizationId=organization_id, total_pages="all"
-        )
-        for network in networks:
-            network_id = network.get("id")
-            if network_id:
-                if network_id not in network_devices_dict:
-                    network_devices_dict[network_id] = {}
-                network_devices_dict[network_id] = network
-    except meraki.APIError as api_error:
+        return await collect_pages(
+            dashboard.organizations.getOrganizationNetworks(
+                organizationId=organization_id, total_pages="all"
+            ),
+            project_network,
+            network_key="id",
+        )
+    except API_ERRORS as api_error:
         logging.warning(api_error)
 
 
-def get_devices(network_devices_dict, dashboard, organization_id):
+async def get_devices(dashboard, organization_id):
     try:
-        devices_statuses = dashboard.organizations.getOrganizationDevicesStatuses(
-            organizationId=organization_id, total_pages="all"
+        devices_statuses = await collect_pages(
+            dashboard.organizations.getOrganizationDevicesStatuses(
+                organizationId=organization_id, total_pages="all"
+            ),
+            project_device,
         )
         logging.debug(f"Got {len(devices_statuses)} Devices")
-
-        for device in devices_statuses:
-            network_id = device.get("networkId")
-            serial = device.get("serial")
-            if network_id and serial:
-                if network_id not in network_devices_dict:
-                    network_devices_dict[network_id] = {}
-                if "devices" not in network_devices_dict[network_id]:
-                    network_devices_dict[network_id]["devices"] = {}
-                network_devices_dict[network_id]["devices"][serial] = device
-    except meraki.APIError as api_error:
+        return devices_statuses
+    except API_ERRORS as api_error:
         logging.warning(api_error)
 
 
-def get_uplinks_loss_and_latency(network_devices_dict, dashboard, organization_id):
+async def get_uplinks_loss_and_latency(dashboard, organization_id):
     try:
-        uplink_loss_and_latency = (
-            dashboard.organizations.getOrganizationDevicesUplinksLossAndLatency(
+        # Not paginated, so the response arrives whole; it is reduced straight away.
+        uplinks = [
+            uplink
+            for uplink in await dashboard.organizations.getOrganizationDevicesUplinksLossAndLatency(
                 organizationId=organization_id,
-                timespan="120",
-                total_pages="all",
+                timespan=str(LOSS_AND_LATENCY_WINDOW or 120),
             )
+            if in_shard(uplink.get("networkId"))
+        ]
+    except API_ERRORS as api_error:
+        logging.warning(api_error)
+        return None
+
+    if LOSS_AND_LATENCY_WINDOW:
+        time_series = [uplink.get("timeSeries") or [] for uplink in uplinks]
+        latency_stats = window_stats(
+            [sample_values(samples, "latencyMs") for samples in time_series]
         )
+        loss_stats = window_stats(
+            [sample_values(samples, "lossPercent") for samples in time_series]
+        )
+    else:
+        latency_stats = loss_stats = [None] * len(uplinks)
+    uplink_loss_and_latency = [
+        project_uplink_loss_and_latency(uplink, latency, loss)
+        for uplink, latency, loss in zip(uplinks, latency_stats, loss_stats)
+    ]
+    logging.debug(f"Got {len(uplink_loss_and_latency)} Device Statuses")
+    return uplink_loss_and_latency
+
 
-        logging.debug(f"Got {len(uplink_loss_and_latency)} Device Statuses")
-
-        for uplink in uplink_loss_and_latency:
-            network_id = uplink.get("networkId")
-            serial = uplink.get("serial")
-            uplink_name = uplink.get("uplink")
-            if serial and uplink_name and network_id in network_devices_dict:
-                if serial in network_devices_dict[network_id]["devices"]:
-                    if (
-                            "uplinks"
-                            not in network_devices_dict[network_id]["devices"][serial]
-                    ):
-                        network_devices_dict[network_id]["devices"][serial][
-                            "uplinks"
-                        ] = {}
-
-                    network_devices_dict[network_id]["devices"][serial]["uplinks"][
-                        uplink_name
-                    ] = {}
-
-                    latency_metric = uplink["timeSeries"][-1]["latencyMs"]
-                    if latency_metric is not None:
-                        network_devices_dict[network_id]["devices"][serial]["uplinks"][
-                            uplink_name
-                        ]["latency"] = (latency_metric / 1000)
-
-                    loss_metric = uplink["timeSeries"][-1]["lossPercent"]
-                    if loss_metric is not None:
-                        network_devices_dict[network_id]["devices"][serial]["uplinks"][
-                            uplink_name
-                        ]["loss"] = loss_metric
-
-    except meraki.APIError as api_error:
+async def get_uplink_statuses(dashboard, organization_id):
+    try:
+        uplink_statuses = await collect_flat_pages(
+            dashboard.appliance.getOrganizationApplianceUplinkStatuses(
+                organizationId=organization_id, total_pages="all"
+            ),
+            project_uplink_statuses,
+        )
+        logging.debug(f"Got {len(uplink_statuses)} Uplink Statuses")
+        return uplink_statuses
+    except API_ERRORS as api_error:
         logging.warning(api_error)
 
 
-def get_uplink_statuses(network_devices_dict, dashboard, organization_id):
+# Dashboard endpoints the exporter calls, by URL path, with the priority their
+# requests get from the rate limiter (lower is served first).
+ENDPOINTS = [
+    ("getOrganizationDevicesStatuses", re.compile(r"/organizations/[^/]+/devices/statuses$"), 0),
+    (
+        "getOrganizationApplianceUplinkStatuses",
+        re.compile(r"/organizations/[^/]+/appliance/uplink/statuses$"),
+        1,
+    ),
+    (
+        "getOrganizationDevicesUplinksLossAndLatency",
+        re.compile(r"/organizations/[^/]+/devices/uplinksLossAndLatency$"),
+        1,
+    ),
+    ("getOrganizationNetworks", re.compile(r"/organizations/[^/]+/networks$"), 2),
+    (
+        "getOrganizationApplianceUplinksUsageByNetwork",
+        re.compile(r"/organizations/[^/]+/appliance/uplinks/usage/byNetwork$"),
+        3,
+    ),
+    (
+        "getNetworkApplianceUplinksUsageHistory",
+        re.compile(r"/networks/[^/]+/appliance/uplinks/usageHistory$"),
+        3,
+    ),
+    ("getOrganizations", re.compile(r"/organizations$"), 2),
+]
+DEFAULT_PRIORITY = 2
+
+
+def endpoint_for_url(url):
+    path = urllib.parse.urlsplit(str(url)).path
+    for endpoint, pattern, priority in ENDPOINTS:
+        if pattern.search(path):
+            return endpoint, priority
+    return "other", DEFAULT_PRIORITY
+
+
+def parse_retry_after(value, default=1.0):
+    """The seconds a Retry-After header asks to wait, or ``default`` if it is not a number."""
     try:
-        uplink_statuses = dashboard.appliance.getOrganizationApplianceUplinkStatuses(
-            organizationId=organization_id, total_pages="all"
+        retry_after = float(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, retry_after) if math.isfinite(retry_after) else default
+
+
+class RateLimiter:
+    """Token bucket shared by every request to one organization, served in priority order.
+
+    Waiting requests are granted tokens lowest priority first, so a burst of
+    per-network usage requests cannot starve device statuses. A 429 pauses
+    every request for its Retry-After, not just the one that received it.
+    """
+
+    def __init__(self, rate, registry, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.dispatcher = None
+        self.throttled_requests = Counter(
+            "meraki_exporter_api_throttled_requests",
+            "Number of API requests rejected with 429 Too Many Requests, by endpoint",
+            ["endpoint"],
+            registry=registry,
+        )
+        self.wait_seconds = Counter(
+            "meraki_exporter_api_rate_limit_wait_seconds",
+            "Time API requests spent waiting for the rate limiter, by endpoint",
+            ["endpoint"],
+            registry=registry,
         )
-        logging.debug(f"Got {len(uplink_statuses)} Uplink Statuses")
 
-        for device in uplink_statuses:
-            network_id = device.get("networkId")
-            serial = device.get("serial")
-            if network_id in network_devices_dict:
-                if serial in network_devices_dict[network_id]["devices"]:
-                    if (
-                            "uplinks"
-                            not in network_devices_dict[network_id]["devices"][serial]
-                    ):
-                        network_devices_dict[network_id]["devices"][serial][
-                            "uplinks"
-                        ] = {}
-                    for uplink in device["uplinks"]:
-                        uplink_name = uplink.get("interface")
-                        if uplink_name and uplink_name not in network_devices_dict[network_id]["devices"][serial][
-                            "uplinks"]:
-                            network_devices_dict[network_id]["devices"][serial][
-                                "uplinks"
-                            ][uplink_name] = {}
-                        uplink_status = uplink.get("status")
-                        if uplink_status:
-                            network_devices_dict[network_id]["devices"][serial]["uplinks"][
-                                uplink_name
-                            ]["status"] = uplink_status
-    except meraki.APIError as api_error:
-        logging.warning(api_error)
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    async def acquire(self, endpoint, priority):
+        now = time.monotonic()
+        self.refill(now)
+        if not self.waiters and now >= self.paused_until and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        await future
+        self.wait_seconds.labels(endpoint).inc(time.monotonic() - now)
+
+    async def dispatch(self):
+        while self.waiters:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.refill(now)
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+
+    def throttled(self, endpoint, retry_after):
+        self.throttled_requests.labels(endpoint).inc()
+        retry_after = parse_retry_after(retry_after)
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        # Tokens only accrue again once the pause is over.
+        self.tokens = 0.0
+        self.updated = self.paused_until
+
+
+class CollectionMetrics:
+    """Self-instrumentation of one organization's collection pipeline."""
+
+    def __init__(self, registry):
+        self.request_duration = Histogram(
+            "meraki_exporter_api_request_duration_seconds",
+            "Latency of Dashboard API requests, by endpoint",
+            ["endpoint"],
+            registry=registry,
+        )
+        self.pages = Counter(
+            "meraki_exporter_api_pages",
+            "Number of successful Dashboard API responses (pages), by endpoint",
+            ["endpoint"],
+            registry=registry,
+        )
+        self.response_bytes = Counter(
+            "meraki_exporter_api_response_bytes",
+            "Bytes received from the Dashboard API, by endpoint",
+            ["endpoint"],
+            registry=registry,
+        )
+        self.errors = Counter(
+            "meraki_exporter_api_errors",
+            "Number of failed Dashboard API requests, by endpoint and HTTP status",
+            ["endpoint", "status"],
+            registry=registry,
+        )
+        self.records = Counter(
+            "meraki_exporter_source_records",
+            "Number of records returned by each data source",
+            ["source"],
+            registry=registry,
+        )
+        self.phase_duration = Histogram(
+            "meraki_exporter_phase_duration_seconds",
+            "Time spent in each collection phase (fetch, join, publish, render, persist), "
+            "by the data source whose refresh triggered it",
+            ["phase", "source"],
+            registry=registry,
+        )
+        self.last_success = Gauge(
+            "meraki_exporter_source_last_success_timestamp_seconds",
+            "Unix time of the last successful refresh of each data source",
+            ["source"],
+            registry=registry,
+        )
+        self.planned_requests = Gauge(
+            "meraki_exporter_planned_requests",
+            "Number of per-network requests a per-network cycle makes, by endpoint",
+            ["endpoint"],
+            registry=registry,
+        )
+        self.skipped_requests = Gauge(
+            "meraki_exporter_skipped_requests",
+            "Number of known networks a per-network endpoint does not apply to, by endpoint",
+            ["endpoint"],
+            registry=registry,
+        )
+        self.snapshot_timestamp = Gauge(
+            "meraki_exporter_snapshot_timestamp_seconds",
+            "Unix time the exported Meraki metrics were last updated",
+            registry=registry,
+        )
+        self.timeouts = Counter(
+            "meraki_exporter_source_timeouts",
+            "Number of refreshes of each data source abandoned for taking too long",
+            ["source"],
+            registry=registry,
+        )
+        self.failures = Counter(
+            "meraki_exporter_source_failures",
+            "Number of failed or abandoned refreshes of each data source",
+            ["source"],
+            registry=registry,
+        )
+        self.circuit_open = Gauge(
+            "meraki_exporter_source_circuit_open",
+            "Whether each data source is backing off after repeated failures (1) or not (0)",
+            ["source"],
+            registry=registry,
+        )
+        self.scrape_deadline_exceeded = Counter(
+            "meraki_exporter_scrape_deadline_exceeded",
+            "Number of scrapes answered with the previous snapshot because "
+            "the refresh they triggered missed the deadline",
+            registry=registry,
+        )
+
+
+# Response fields holding names, identifiers or addresses, replaced in
+# anonymised recordings; the shape of the data and all measurements are kept.
+ANONYMISED_FIELDS = {
+    "address",
+    "apn",
+    "configTemplateId",
+    "deviceName",
+    "dns1",
+    "dns2",
+    "enrollmentString",
+    "gateway",
+    "iccid",
+    "id",
+    "imei",
+    "imsi",
+    "ip",
+    "lanIp",
+    "mac",
+    "msisdn",
+    "name",
+    "networkId",
+    "networkName",
+    "notes",
+    "organizationId",
+    "primaryDns",
+    "provider",
+    "publicIp",
+    "secondaryDns",
+    "serial",
+    "tags",
+    "url",
+}
+# The path segment following the first of these is an identifier, as are
+# these query parameters (page cursors).
+ANONYMISED_PATH_PREFIXES = {"organizations", "networks", "devices"}
+ANONYMISED_PARAMETERS = {"startingAfter", "endingBefore"}
+LINK = re.compile(r"<([^>]*)>\s*;\s*rel=\"?(\w+)\"?")
+
+
+class ResponseRecorder:
+    """Appends every Dashboard API response an organization receives to a gzipped JSON lines file.
+
+    Each line holds the request's path and query, when it was sent and how
+    long the response took, the status, the ``Link`` and ``Retry-After``
+    headers, and the body. URLs are stored without the API host, so
+    ``mock_api/replay_server.py`` can serve the recording back as is. With
+    ``anonymise`` the identifiers, names and addresses in bodies, URLs and
+    page links are replaced by pseudonyms of the same shape, keyed by a
+    random salt that is not saved, so they are consistent within the
+    recording and cannot be reversed from it.
+    """
+
+    def __init__(self, directory, organization_id, anonymise=False):
+        self.salt = os.urandom(16) if anonymise else None
+        name = f"{self.pseudonym(organization_id)}-{time.strftime('%Y%m%dT%H%M%S')}.jsonl.gz"
+        self.path = os.path.join(directory, name)
+        self.file = gzip.open(self.path, "wt", compresslevel=6)
+        self.started = time.monotonic()
+
+    def pseudonym(self, value):
+        """``value`` with every letter and digit replaced, keeping its length and punctuation."""
+        if self.salt is None or not isinstance(value, str):
+            return value
+        digest = hashlib.shake_256(self.salt + value.encode()).digest(len(value))
+        return "".join(
+            str(byte % 10)
+            if char.isdigit()
+            else chr(65 + byte % 26)
+            if char.isupper()
+            else chr(97 + byte % 26)
+            if char.islower()
+            else char
+            for char, byte in zip(value, digest)
+        )
+
+    def anonymise_value(self, value):
+        if isinstance(value, dict):
+            return {
+                key: (
+                    self.anonymise_field(item)
+                    if key in ANONYMISED_FIELDS
+                    else self.anonymise_value(item)
+                )
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [self.anonymise_value(item) for item in value]
+        return value
+
+    def anonymise_field(self, value):
+        if isinstance(value, list):
+            return [self.pseudonym(item) for item in value]
+        if isinstance(value, dict):
+            return self.anonymise_value(value)
+        return self.pseudonym(value)
+
+    def relative_url(self, url):
+        """``url`` as a path and query, with its identifiers replaced when anonymising."""
+        url = urllib.parse.urlsplit(str(url))
+        if self.salt is None:
+            return urllib.parse.urlunsplit(("", "", url.path, url.query, ""))
+        segments = url.path.split("/")
+        # Only the first: in /organizations/{id}/devices/statuses "statuses" is no serial.
+        for index in range(1, len(segments)):
+            if segments[index - 1] in ANONYMISED_PATH_PREFIXES:
+                segments[index] = self.pseudonym(segments[index])
+                break
+        query = [
+            (key, self.pseudonym(value) if key in ANONYMISED_PARAMETERS else value)
+            for key, value in urllib.parse.parse_qsl(url.query, keep_blank_values=True)
+        ]
+        return urllib.parse.urlunsplit(
+            ("", "", "/".join(segments), urllib.parse.urlencode(query), "")
+        )
+
+    def record(self, method, response, body, start, duration):
+        headers = {}
+        link = response.headers.get("Link")
+        if link:
+            headers["Link"] = ", ".join(
+                f"<{self.relative_url(url)}>; rel={rel}" for url, rel in LINK.findall(link)
+            )
+        if "Retry-After" in response.headers:
+            headers["Retry-After"] = response.headers["Retry-After"]
+        text = body.decode(errors="replace")
+        if self.salt is not None and text:
+            try:
+                text = json.dumps(self.anonymise_value(json.loads(text)), separators=(",", ":"))
+            except ValueError:
+                pass
+        self.file.write(
+            json.dumps(
+                {
+                    "time": round(start - self.started, 3),
+                    "duration": round(duration, 3),
+                    "method": method,
+                    "url": self.relative_url(response.url),
+                    "status": response.status,
+                    "headers": headers,
+                    "body": text,
+                }
+            )
+            + "\n"
+        )
+        # Flushed every time, so a recording cut short by a kill is readable up to here.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def instrument_requests(dashboard, rate_limiter, metrics, recorder=None):
+    """Send every HTTP request of a Dashboard client through ``rate_limiter`` and measure it.
+
+    The hook sits below the SDK's pagination and retry loops, so every page
+    and every retry spends a token and is counted, and recorded when a
+    ``recorder`` is given. meraki<2 keeps its aiohttp session in
+    ``_session._req_session``.
+    """
+    if isinstance(dashboard, DashboardClient):
+        client = dashboard.session
+        base_url = dashboard.base_url
+    else:
+        client = dashboard._session._req_session
+        base_url = dashboard._session._base_url
+    send = client.request
+
+    async def request(method, url, **kwargs):
+        # meraki<2 only follows next-page links on meraki.com as they are and
+        # prefixes the base URL onto any other, e.g. a proxy given with -m.
+        if url.startswith(base_url) and "://" in url[len(base_url) :]:
+            url = url[len(base_url) :]
+        endpoint, priority = endpoint_for_url(url)
+        await rate_limiter.acquire(endpoint, priority)
+        start = time.monotonic()
+        try:
+            response = await send(method, url, **kwargs)
+            # aiohttp keeps the body, so the SDK's own read of it is free.
+            body = await response.read()
+        except Exception:
+            metrics.errors.labels(endpoint, "error").inc()
+            raise
+        duration = time.monotonic() - start
+        metrics.request_duration.labels(endpoint).observe(duration)
+        if recorder is not None:
+            recorder.record(method, response, body, start, duration)
+        metrics.response_bytes.labels(endpoint).inc(len(body))
+        if 200 <= response.status < 300:
+            metrics.pages.labels(endpoint).inc()
+        else:
+            metrics.errors.labels(endpoint, str(response.status)).inc()
+        if response.status == 429:
+            rate_limiter.throttled(endpoint, response.headers.get("Retry-After"))
+        return response
+
+    client.request = request
+
+
+# Response schemas for the built-in client: with msgspec, only these fields
+# of each response are decoded and everything else is skipped unparsed.
+
+
+class NetworkSchema(TypedDict, total=False):
+    id: str
+    name: Optional[str]
+    productTypes: Optional[list[str]]
+
+
+class DeviceStatusSchema(TypedDict, total=False):
+    serial: Optional[str]
+    networkId: Optional[str]
+    name: Optional[str]
+    mac: Optional[str]
+    status: Optional[str]
+    usingCellularFailover: Optional[bool]
+    productType: Optional[str]
+    model: Optional[str]
+
 
+class LossAndLatencySampleSchema(TypedDict, total=False):
+    ts: str
+    latencyMs: Optional[float]
+    lossPercent: Optional[float]
 
-def get_uplink_usage(network_devices_dict, dashboard):
-    for network_id in network_devices_dict.keys():
+
+class UplinkLossAndLatencySchema(TypedDict, total=False):
+    networkId: Optional[str]
+    serial: Optional[str]
+    uplink: Optional[str]
+    timeSeries: Optional[list[LossAndLatencySampleSchema]]
+
+
+class UplinkStatusSchema(TypedDict, total=False):
+    interface: Optional[str]
+    status: Optional[str]
+
+
+class ApplianceUplinkStatusesSchema(TypedDict, total=False):
+    networkId: Optional[str]
+    serial: Optional[str]
+    uplinks: list[UplinkStatusSchema]
+
+
+class UplinkUsageSchema(TypedDict, total=False):
+    interface: Optional[str]
+    sent: Optional[float]
+    received: Optional[float]
+
+
+class NetworkUplinksUsageSchema(TypedDict, total=False):
+    networkId: Optional[str]
+    byUplink: list[UplinkUsageSchema]
+
+
+class UplinksUsageHistorySchema(TypedDict, total=False):
+    startTime: str
+    endTime: str
+    byInterface: list[UplinkUsageSchema]
+
+
+class OrganizationApiSchema(TypedDict, total=False):
+    enabled: bool
+
+
+class OrganizationSchema(TypedDict, total=False):
+    id: str
+    name: Optional[str]
+    api: OrganizationApiSchema
+
+
+if msgspec is not None:
+    DECODERS = {
+        # Not strict, so numbers sent as strings are still accepted.
+        schema: msgspec.json.Decoder(list[schema], strict=False)
+        for schema in (
+            NetworkSchema,
+            DeviceStatusSchema,
+            UplinkLossAndLatencySchema,
+            ApplianceUplinkStatusesSchema,
+            NetworkUplinksUsageSchema,
+            UplinksUsageHistorySchema,
+            OrganizationSchema,
+        )
+    }
+    DECODE_ERRORS = (msgspec.DecodeError,)
+elif orjson is not None:
+    DECODE_ERRORS = (orjson.JSONDecodeError,)
+else:
+    DECODE_ERRORS = (ValueError,)
+
+
+def decode_response(body, schema):
+    """Decode a JSON array response, with msgspec into just ``schema``'s fields when installed."""
+    if msgspec is not None:
+        return DECODERS[schema].decode(body)
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+class DashboardClient:
+    """Lean asyncio client for just the Dashboard endpoints the exporter calls.
+
+    Its methods take the same arguments as the meraki SDK's and behave like
+    an SDK client created with ``use_iterator_for_get_pages``: paginated
+    calls return an async iterator over the items of every page, following
+    the ``Link`` header, and the others return the decoded response. Every
+    request goes through one pooled keep-alive aiohttp session. Connection
+    errors, 429 and 5xx responses are retried like the SDK does; anything
+    else, or running out of retries, raises DashboardAPIError.
+    """
+
+    def __init__(
+        self, api_key, base_url, maximum_concurrent_requests=8, maximum_retries=2, timeout=60
+    ):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.maximum_concurrent_requests = maximum_concurrent_requests
+        self.maximum_retries = maximum_retries
+        self.timeout = timeout
+        self.session = None
+        # The SDK groups its methods by API section; the getters call them as such.
+        self.organizations = self.appliance = self
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.maximum_concurrent_requests),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Accept": "application/json",
+                "User-Agent": "meraki-api-exporter",
+            },
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def get(self, operation, url, params, schema):
+        """GET ``url`` and return its decoded body and the response, retrying as the SDK does."""
+        for attempt in range(self.maximum_retries + 1):
+            retry_after = 1.0
+            try:
+                response = await self.session.request("GET", url, params=params)
+                # Reading the whole body releases the connection back to the pool.
+                body = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                status, reason, message = None, type(error).__name__, str(error)
+            else:
+                status, reason = response.status, response.reason
+                if 200 <= status < 300:
+                    try:
+                        return decode_response(body, schema), response
+                    except DECODE_ERRORS as error:
+                        raise DashboardAPIError(operation, status, "Invalid JSON", error)
+                message = body[:200].decode(errors="replace")
+                if status == 429:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                elif status < 500:
+                    break
+            if attempt < self.maximum_retries:
+                await asyncio.sleep(retry_after)
+        raise DashboardAPIError(operation, status, reason, message)
+
+    async def pages(self, operation, path, schema, params, total_pages="all"):
+        url = self.base_url + path
+        page = 0
+        while url and (total_pages in ("all", -1) or page < total_pages):
+            items, response = await self.get(operation, url, params, schema)
+            page += 1
+            for item in items:
+                yield item
+            # The next link carries the query, including the page cursor.
+            next_page = response.links.get("next")
+            url = str(next_page["url"]) if next_page else None
+            params = None
+
+    async def single_page(self, operation, path, schema, params=None):
+        items, _ = await self.get(operation, self.base_url + path, params, schema)
+        return items
+
+    async def getOrganizations(self):
+        return [
+            organization
+            async for organization in self.pages(
+                "getOrganizations", "/organizations", OrganizationSchema, None
+            )
+        ]
+
+    def getOrganizationNetworks(self, organizationId, total_pages="all"):
+        return self.pages(
+            "getOrganizationNetworks",
+            f"/organizations/{organizationId}/networks",
+            NetworkSchema,
+            None,
+            total_pages,
+        )
+
+    def getOrganizationDevicesStatuses(self, organizationId, total_pages="all"):
+        return self.pages(
+            "getOrganizationDevicesStatuses",
+            f"/organizations/{organizationId}/devices/statuses",
+            DeviceStatusSchema,
+            None,
+            total_pages,
+        )
+
+    async def getOrganizationDevicesUplinksLossAndLatency(self, organizationId, timespan=None):
+        return await self.single_page(
+            "getOrganizationDevicesUplinksLossAndLatency",
+            f"/organizations/{organizationId}/devices/uplinksLossAndLatency",
+            UplinkLossAndLatencySchema,
+            {"timespan": timespan} if timespan is not None else None,
+        )
+
+    def getOrganizationApplianceUplinkStatuses(self, organizationId, total_pages="all"):
+        return self.pages(
+            "getOrganizationApplianceUplinkStatuses",
+            f"/organizations/{organizationId}/appliance/uplink/statuses",
+            ApplianceUplinkStatusesSchema,
+            None,
+            total_pages,
+        )
+
+    async def getOrganizationApplianceUplinksUsageByNetwork(self, organizationId, timespan=None):
+        return await self.single_page(
+            "getOrganizationApplianceUplinksUsageByNetwork",
+            f"/organizations/{organizationId}/appliance/uplinks/usage/byNetwork",
+            NetworkUplinksUsageSchema,
+            {"timespan": timespan} if timespan is not None else None,
+        )
+
+    async def getNetworkApplianceUplinksUsageHistory(
+        self, networkId, timespan=None, resolution=None
+    ):
+        params = {}
+        if timespan is not None:
+            params["timespan"] = timespan
+        if resolution is not None:
+            params["resolution"] = resolution
+        return await self.single_page(
+            "getNetworkApplianceUplinksUsageHistory",
+            f"/networks/{networkId}/appliance/uplinks/usageHistory",
+            UplinksUsageHistorySchema,
+            params,
+        )
+
+
+class UsageCounters:
+    """Running byte totals of every network uplink, summed from usage history buckets.
+
+    Each bucket is added once, keyed by its start time, so overlapping history
+    windows never count a minute twice and polling less often than the bucket
+    size loses nothing. A bucket that ended less than a bucket ago may still
+    be filling, so it is left for the next poll.
+    """
+
+    def __init__(self, resolution=60):
+        self.resolution = resolution
+        self.totals = {}
+        self.counted_until = {}
+
+    def add(self, network_id, buckets):
+        counted_until = self.counted_until.get(network_id, 0)
+        settled = time.time() - self.resolution
+        new_buckets = []
+        for bucket in buckets:
+            try:
+                start = parse_timestamp(bucket["startTime"])
+                end = parse_timestamp(bucket["endTime"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if start > counted_until and end <= settled:
+                new_buckets.append((start, bucket))
+        if not new_buckets:
+            return
+
+        totals = self.totals.setdefault(network_id, {})
+        for start, bucket in sorted(new_buckets, key=lambda new_bucket: new_bucket[0]):
+            for interface in bucket.get("byInterface", []):
+                uplink_name = interface.get("interface")
+                if uplink_name is None:
+                    continue
+                uplink_totals = totals.setdefault(intern_label(uplink_name), [0.0, 0.0])
+                uplink_totals[0] += float(interface.get("sent") or 0)
+                uplink_totals[1] += float(interface.get("received") or 0)
+        self.counted_until[network_id] = max(start for start, _ in new_buckets)
+
+    def prune(self, network_ids):
+        """Forget the networks that are not in ``network_ids``, as they are no longer polled."""
+        network_ids = set(network_ids)
+        for counts in (self.totals, self.counted_until):
+            for network_id in counts.keys() - network_ids:
+                del counts[network_id]
+
+
+async def get_network_uplink_usage(
+    dashboard, semaphore, network_id, counters=None, timespan=600
+):
+    async with semaphore:
         try:
             uplink_usage_list = (
-                dashboard.appliance.getNetworkApplianceUplinksUsageHistory(
-                    networkId=network_id
+                await dashboard.appliance.getNetworkApplianceUplinksUsageHistory(
+                    networkId=network_id, timespan=timespan, resolution=60
                 )
             )
-            if "interfaces" not in network_devices_dict[network_id]:
-                network_devices_dict[network_id]["interfaces"] = {}
-
-            interface_dict = uplink_usage_list[-1]["byInterface"]
-            for interface in interface_dict:
-                if interface.get("sent") is not None and interface.get("received") is not None:
-                    network_devices_dict[network_id]["interfaces"][
-                        interface["interface"]
-                    ] = {"sent": interface["sent"], "received": interface["received"]}
-            logging.debug(
-                f"Got {len(interface_dict)} Uplink Usages for network {network_id}"
-            )
-        except meraki.APIError as api_error:
+        except API_ERRORS as api_error:
             logging.warning(api_error)
+            return None
+    if not uplink_usage_list:
+        return {}
+
+    interface_dict = uplink_usage_list[-1]["byInterface"]
+    logging.debug(f"Got {len(interface_dict)} Uplink Usages for network {network_id}")
+    interfaces = {}
+    for interface in interface_dict:
+        if interface.get("sent") is not None and interface.get("received") is not None:
+            interfaces[interface["interface"]] = {
+                "sent": interface["sent"],
+                "received": interface["received"],
+            }
+    if counters is not None:
+        counters.add(network_id, uplink_usage_list)
+        for uplink_name, (sent, received) in counters.totals.get(network_id, {}).items():
+            uplink = interfaces.setdefault(uplink_name, {})
+            uplink["sent_total"] = sent
+            uplink["received_total"] = received
+    return interfaces
+
+
+async def get_uplink_usage(
+    network_ids, dashboard, max_workers, counters=None, timespan=600, previous=None
+):
+    """The uplink usage of each network, or None when every request failed.
+
+    A network whose request fails keeps its usage from ``previous``, and the
+    ``counters`` of networks no longer in ``network_ids`` are dropped.
+    """
+    if counters is not None:
+        counters.prune(network_ids)
+    semaphore = asyncio.Semaphore(max_workers)
+    uplink_usages = await asyncio.gather(
+        *(
+            get_network_uplink_usage(dashboard, semaphore, network_id, counters, timespan)
+            for network_id in network_ids
+        )
+    )
+    if network_ids and all(interfaces is None for interfaces in uplink_usages):
+        return None
+    previous = previous or {}
+    usages = {}
+    for network_id, interfaces in zip(network_ids, uplink_usages):
+        if interfaces is None:
+            interfaces = previous.get(network_id)
+        if interfaces is not None:
+            usages[network_id] = interfaces
+    return usages
+
+
+async def get_uplink_usage_by_network(dashboard, organization_id, timespan):
+    try:
+        uplink_usage = (
+            await dashboard.appliance.getOrganizationApplianceUplinksUsageByNetwork(
+                organizationId=organization_id, timespan=timespan
+            )
+        )
+    except API_ERRORS as api_error:
+        logging.warning(api_error)
+        return None
+    logging.debug(f"Got {len(uplink_usage)} Network Uplink Usages")
+
+    uplink_usages = {}
+    for network in uplink_usage:
+        network_id = network.get("networkId")
+        if not network_id or not in_shard(network_id):
+            continue
+        interfaces = uplink_usages.setdefault(network_id, {})
+        for uplink in network.get("byUplink", []):
+            uplink_name = uplink.get("interface")
+            if uplink_name is None or uplink.get("sent") is None or uplink.get("received") is None:
+                continue
+            # Normalise to bytes per minute, and sum the uplinks of HA appliance pairs.
+            if uplink_name not in interfaces:
+                interfaces[uplink_name] = {"sent": 0, "received": 0}
+            interfaces[uplink_name]["sent"] += float(uplink["sent"]) * 60 / timespan
+            interfaces[uplink_name]["received"] += float(uplink["received"]) * 60 / timespan
+    return uplink_usages
+
+
+async def get_uplink_usages(
+    dashboard,
+    organization_id,
+    network_ids,
+    max_workers,
+    usage_mode="bulk",
+    usage_timespan=60,
+    counters=None,
+    history_timespan=600,
+    previous=None,
+):
+    if usage_mode == "bulk":
+        uplink_usages = await get_uplink_usage_by_network(
+            dashboard, organization_id, usage_timespan
+        )
+        if uplink_usages is not None:
+            return uplink_usages
+        logging.warning("Falling back to per-network uplink usage")
+    return await get_uplink_usage(
+        network_ids, dashboard, max_workers, counters, history_timespan, previous
+    )
+
+
+class Device:
+    """A device as the exporter reports it, with the labels of all of its series."""
+
+    __slots__ = ("serial", "network_id", "labels", "status", "using_cellular_failover")
+
+    def __init__(self, serial, network_id, labels, status, using_cellular_failover):
+        self.serial = serial
+        self.network_id = network_id
+        self.labels = labels
+        self.status = status
+        self.using_cellular_failover = using_cellular_failover
+
+
+class Inventory:
+    """The network list and device statuses joined: network names by ID and devices by serial.
+
+    These are what every series is labelled with. The other sources are
+    published straight from their records, looking their devices and
+    networks up here, so networks are kept as just their names and there is
+    no per-refresh record of each uplink or network to build and discard.
+    """
+
+    def __init__(self):
+        self.network_names = {}
+        self.devices = {}
+        # Networks that devices are in but the network list does not have.
+        self.unknown_networks = set()
+
+    def device_labels(self, network_id, serial):
+        """The labels of ``serial``'s series, or None when it is unknown, elsewhere or in an unnamed network."""
+        device = self.devices.get(serial)
+        if device is None or device.network_id != network_id:
+            return None
+        return device.labels
+
+    def same_labels(self, other):
+        """Whether every series is labelled the same in ``other``."""
+        if self.network_names != other.network_names or len(self.devices) != len(other.devices):
+            return False
+        for serial, device in self.devices.items():
+            other_device = other.devices.get(serial)
+            if other_device is None or (device.network_id, device.labels) != (
+                other_device.network_id,
+                other_device.labels,
+            ):
+                return False
+        return True
+
+
+def build_inventory(networks, devices_statuses):
+    inventory = Inventory()
+    for network_id, name, _ in networks or []:
+        if network_id:
+            inventory.network_names[network_id] = name
+    for serial, network_id, name, status, using_cellular_failover, _ in devices_statuses or []:
+        if network_id and serial:
+            network_name = inventory.network_names.get(network_id)
+            if network_name is None:
+                # Not in the network list (yet), so there is no name to label it with.
+                inventory.unknown_networks.add(network_id)
+                labels = None
+            else:
+                labels = (network_id, network_name, serial, name)
+            inventory.devices[serial] = Device(
+                serial, network_id, labels, status, using_cellular_failover
+            )
+    return inventory
+
+
+def plan_usage_requests(networks, devices):
+    """The networks the appliance usage history endpoint applies to, and how many networks are known.
+
+    A network is planned when its product types include an appliance, when
+    a device in it is an appliance, or when its product types are unknown.
+    Wireless or switch only networks, and networks only seen through
+    devices that are not appliances, are skipped.
+    """
+    known = set()
+    planned = set()
+    for network_id, _, product_types in networks or []:
+        known.add(network_id)
+        if product_types is None or "appliance" in product_types:
+            planned.add(network_id)
+    for device in devices or []:
+        network_id, product_type = device[1], device[5]
+        known.add(network_id)
+        if product_type == "appliance":
+            planned.add(network_id)
+    known.discard(None)
+    planned.discard(None)
+    return sorted(planned), len(known)
+
+
+class UsagePlan:
+    """Caches the per-network usage plan until the network list or device statuses are replaced."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.inputs = (None, None)
+        self.network_ids = []
+
+    def __call__(self, results):
+        networks, devices = results.get("networks"), results.get("devices")
+        if networks is not self.inputs[0] or devices is not self.inputs[1]:
+            self.inputs = (networks, devices)
+            self.network_ids, known = plan_usage_requests(networks, devices)
+            endpoint = "getNetworkApplianceUplinksUsageHistory"
+            self.metrics.planned_requests.labels(endpoint).set(len(self.network_ids))
+            self.metrics.skipped_requests.labels(endpoint).set(known - len(self.network_ids))
+        return self.network_ids
+
+
+class Source:
+    """One Dashboard API data source, polled on its own interval."""
+
+    def __init__(self, name, fetch, interval, jitter=0.0, after=(), timeout=None):
+        self.name = name
+        self.fetch = fetch
+        self.interval = interval
+        self.jitter = jitter
+        self.after = after
+        self.timeout = timeout
+        self.refreshed = None
+        self.loaded = asyncio.Event()
+        # Set to refresh before the interval is up.
+        self.wake = asyncio.Event()
+        # Consecutive failed refreshes, and when to try again after the last one.
+        self.failures = 0
+        self.retry_at = None
+
+
+class Scheduler:
+    """Polls each source on its own deadline and republishes after every refresh.
+
+    Deadlines are kept on the monotonic clock and advance by whole intervals,
+    so collection time never makes the period drift. The latest successful
+    result of every source is kept in ``results``; a failed refresh leaves the
+    previous one in place, so whatever else was collected is still published,
+    and is reported to ``on_update`` with no results.
+
+    A refresh that takes longer than the source's timeout is abandoned and
+    counts as failed. A failed refresh is retried after ``RETRY_DELAY``,
+    doubling with every failure in a row up to the source's interval, so a
+    source polled hourly is not left empty for an hour by one error. After
+    ``BREAKER_THRESHOLD`` failures in a row the source's circuit opens and
+    the delay keeps doubling up to ``BREAKER_MAX_BACKOFF``; the first
+    successful refresh closes it again.
+    """
+
+    def __init__(self, on_update, metrics):
+        self.on_update = on_update
+        self.metrics = metrics
+        self.sources = {}
+        self.results = {}
+        self.last_success = {}
+
+    def add_source(self, name, fetch, interval, jitter=0.0, after=(), timeout=None):
+        self.sources[name] = Source(name, fetch, interval, jitter, after, timeout)
+
+    async def run(self):
+        await asyncio.gather(*(self.poll(source) for source in self.sources.values()))
+
+    async def refresh(self, source, timeout=None):
+        start = time.monotonic()
+        source.wake.clear()
+        if source.retry_at is not None and start < source.retry_at:
+            return
+        if source.timeout is not None and (timeout is None or source.timeout < timeout):
+            timeout = source.timeout
+        result = None
+        try:
+            result = await asyncio.wait_for(source.fetch(), timeout)
+        except asyncio.TimeoutError:
+            self.metrics.timeouts.labels(source.name).inc()
+            logging.warning(f"Refresh of {source.name} abandoned after {timeout:.1f} seconds")
+        finally:
+            source.refreshed = start
+            source.loaded.set()
+        if result is None:
+            self.failed(source, start)
+        else:
+            self.results[source.name] = result
+            self.metrics.records.labels(source.name).inc(len(result))
+            self.last_success[source.name] = time.time()
+            self.metrics.last_success.labels(source.name).set(self.last_success[source.name])
+            if source.failures >= BREAKER_THRESHOLD:
+                logging.info(f"Circuit of {source.name} closed")
+            source.failures = 0
+            source.retry_at = None
+            self.metrics.circuit_open.labels(source.name).set(0)
+        self.metrics.phase_duration.labels("fetch", source.name).observe(
+            time.monotonic() - start
+        )
+        self.on_update(source.name, None if result is None else self.results)
+
+    def failed(self, source, start):
+        source.failures += 1
+        self.metrics.failures.labels(source.name).inc()
+        # Counted from the start of the refresh, like the poll deadlines.
+        backoff = RETRY_DELAY * 2 ** (source.failures - 1)
+        if source.failures < BREAKER_THRESHOLD:
+            source.retry_at = start + min(backoff, source.interval)
+            return
+        backoff = min(backoff, max(source.interval, BREAKER_MAX_BACKOFF))
+        source.retry_at = start + backoff
+        self.metrics.circuit_open.labels(source.name).set(1)
+        logging.warning(
+            f"Circuit of {source.name} open after {source.failures} failed refreshes, "
+            f"retrying in {backoff:g} seconds"
+        )
+
+    async def refresh_due(self, budget=None):
+        """Refresh, once, every source whose interval has passed since its last refresh.
+
+        Used instead of ``run`` when collection is driven by scrapes. Failed
+        sources are due again once their retry delay has passed, and sources
+        asked to refresh early straight away. Sources with dependencies are
+        refreshed after the others. With a ``budget``
+        the whole refresh takes at most that many seconds: each source gets
+        what is left of it as its timeout, and sources left with none are not
+        refreshed this time.
+        """
+        now = time.monotonic()
+        end = None if budget is None else now + budget
+        due = [
+            source
+            for source in self.sources.values()
+            if source.refreshed is None
+            or now - source.refreshed >= source.interval
+            or (source.retry_at is not None and now >= source.retry_at)
+            or source.wake.is_set()
+        ]
+        for dependent in (False, True):
+            timeout = None if end is None else end - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            await asyncio.gather(
+                *(
+                    self.refresh(source, timeout)
+                    for source in due
+                    if bool(source.after) == dependent
+                )
+            )
+
+    async def poll(self, source):
+        for name in source.after:
+            await self.sources[name].loaded.wait()
+
+        deadline = time.monotonic()
+        while True:
+            await self.refresh(source)
+
+            if source.retry_at is not None:
+                # Failed: the periods start over from the retry.
+                deadline = source.retry_at
+                await self.sleep_until(source, deadline)
+                continue
+            deadline += source.interval
+            now = time.monotonic()
+            if deadline < now:
+                # Skip the periods we overran instead of firing them back to back.
+                deadline += ((now - deadline) // source.interval + 1) * source.interval
+            await self.sleep_until(source, deadline + random.uniform(0, source.jitter))
+
+    async def sleep_until(self, source, when):
+        """Sleep until ``when`` on the monotonic clock, or until ``source`` is asked to refresh early."""
+        try:
+            await asyncio.wait_for(source.wake.wait(), max(0.0, when - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+
+    def refresh_early(self, name):
+        """Refresh source ``name`` now rather than when its interval is up.
+
+        Ignored if it was refreshed within ``EARLY_REFRESH_INTERVAL``, or has
+        not been refreshed at all yet, and a failing source still waits for
+        its retry delay. Returns whether the refresh was asked for.
+        """
+        source = self.sources.get(name)
+        if source is None or source.refreshed is None or source.wake.is_set():
+            return False
+        if time.monotonic() - source.refreshed < EARLY_REFRESH_INTERVAL:
+            return False
+        source.wake.set()
+        return True
+
+
+MetricDefinition = namedtuple(
+    "MetricDefinition", ["name", "documentation", "labels", "kind"], defaults=["gauge"]
+)
+
 
+def metric_family(metric):
+    if metric.kind == "counter":
+        return CounterMetricFamily(metric.name, metric.documentation, labels=metric.labels)
+    return GaugeMetricFamily(metric.name, metric.documentation, labels=metric.labels)
 
-def get_usage(dashboard, organization_id):
-    network_devices_dict = {}
-    get_networks(network_devices_dict, dashboard, organization_id)
-    get_devices(network_devices_dict, dashboard, organization_id)
-    get_uplinks_loss_and_latency(network_devices_dict, dashboard, organization_id)
-    get_uplink_statuses(network_devices_dict, dashboard, organization_id)
-    get_uplink_usage(network_devices_dict, dashboard)
 
-    return network_devices_dict
+class SeriesValue:
+    """The latest value of one series, and its sample, built once per value."""
+
+    __slots__ = ("value", "updated", "sample")
+
+    def __init__(self, value, updated, sample):
+        self.value = value
+        self.updated = updated
+        self.sample = sample
+
+
+class SeriesTracker:
+    """Holds the latest value of every Meraki series and expires the stale ones.
+
+    Each series remembers when it was last published, and a series of a
+    metric that is published again without it for more than ``ttl`` seconds
+    is dropped, so devices and networks that disappear (or change name) stop
+    being exported instead of lingering forever.
+
+    Setting a series to the value it already has only refreshes its time.
+    Samples are built when a value changes, and a metric family is rebuilt
+    only when one of its series changed, appeared or expired, so publishing
+    costs what changed rather than the size of the fleet.
+    """
+
+    def __init__(self, ttl, registry):
+        self.ttl = ttl
+        self.published_at = time.monotonic()
+        self.metrics = MERAKI_METRICS
+        self.series = {metric.name: {} for metric in self.metrics}
+        self.changed = {metric.name for metric in self.metrics}
+        self.family_cache = {}
+        self.series_live = Gauge(
+            "meraki_exporter_series",
+            "Number of series currently exported, by metric",
+            ["metric"],
+            registry=registry,
+        )
+        self.series_evicted = Counter(
+            "meraki_exporter_series_evicted",
+            "Number of stale series removed, by metric",
+            ["metric"],
+            registry=registry,
+        )
+
+    def begin_publish(self):
+        self.published_at = time.monotonic()
+
+    def set(self, metric, labels, value, timestamp=None):
+        value = float(value)
+        series = self.series[metric.name]
+        current = series.get(labels)
+        if current is not None and current.value == value and current.sample.timestamp == timestamp:
+            current.updated = self.published_at
+            return
+        series[labels] = SeriesValue(
+            value,
+            self.published_at,
+            Sample(
+                f"{metric.name}_total" if metric.kind == "counter" else metric.name,
+                dict(zip(metric.labels, labels)),
+                value,
+                timestamp,
+                None,
+            ),
+        )
+        self.changed.add(metric.name)
+
+    def evict_stale(self, metrics):
+        """Drop the series of ``metrics``, just published, that have not been published for ``ttl``."""
+        cutoff = time.monotonic() - self.ttl
+        for metric in metrics:
+            series = self.series[metric.name]
+            stale = [labels for labels, current in series.items() if current.updated < cutoff]
+            for labels in stale:
+                del series[labels]
+            if stale:
+                self.changed.add(metric.name)
+                self.series_evicted.labels(metric.name).inc(len(stale))
+                logging.debug(f"Evicted {len(stale)} stale {metric.name} series")
+            self.series_live.labels(metric.name).set(len(series))
+
+    def families(self):
+        for metric in self.metrics:
+            if metric.name in self.changed:
+                family = metric_family(metric)
+                family.samples = [current.sample for current in self.series[metric.name].values()]
+                self.family_cache[metric.name] = family
+        self.changed.clear()
+        return [self.family_cache[metric.name] for metric in self.metrics]
+
+
+class SnapshotCollector:
+    """Serves the Meraki metric families from the last published snapshot.
+
+    A snapshot is built completely off to the side and then published with a
+    single reference assignment, so a scrape never waits for collection and
+    never sees a half-updated set of metrics.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.snapshot = ()
+
+    def publish(self, families):
+        self.snapshot = tuple(families)
+
+    def collect(self):
+        return iter(self.snapshot)
+
+    def describe(self):
+        return [
+            metric_family(metric)
+            for metric in self.metrics
+        ]
+
+
+class SingleFamily:
+    """A registry of one metric family, for the exposition encoders."""
+
+    __slots__ = ("family",)
+
+    def __init__(self, family):
+        self.family = family
+
+    def collect(self):
+        return [self.family]
+
+
+OPENMETRICS_EOF = b"# EOF\n"
+
+
+class ExpositionCache:
+    """The registry rendered once per cycle, in every format a scrape can ask for.
+
+    Text and OpenMetrics bodies are rendered and gzipped in ``render``; scrapes
+    are then answered straight from memory, however many Prometheus servers
+    ask for the same unchanged payload.
+
+    Each family is rendered on its own and kept with the family object it
+    was rendered from. The Meraki families are the same objects until one of
+    their series changes, so only the changed ones are rendered again.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.rendered = {}
+        self.families = {}
+
+    def render(self):
+        families = {}
+        text = []
+        openmetrics = []
+        for family in self.registry.collect():
+            cached = self.families.get(family.name)
+            if cached is None or cached[0] is not family:
+                single = SingleFamily(family)
+                cached = (
+                    family,
+                    generate_latest(single),
+                    generate_openmetrics(single)[: -len(OPENMETRICS_EOF)],
+                )
+            families[family.name] = cached
+            text.append(cached[1])
+            openmetrics.append(cached[2])
+        self.families = families
+        openmetrics.append(OPENMETRICS_EOF)
+
+        rendered = {}
+        for use_openmetrics, parts, content_type in (
+            (False, text, CONTENT_TYPE_LATEST),
+            (True, openmetrics, OPENMETRICS_CONTENT_TYPE_LATEST),
+        ):
+            body = b"".join(parts)
+            digest = hashlib.sha1(body).hexdigest()
+            rendered[(use_openmetrics, False)] = (content_type, body, f'"{digest}"')
+            rendered[(use_openmetrics, True)] = (
+                content_type,
+                gzip.compress(body, compresslevel=6),
+                f'"{digest}-gzip"',
+            )
+        self.rendered = rendered
+
+    def get(self, use_openmetrics, use_gzip):
+        rendered = self.rendered
+        if (use_openmetrics, use_gzip) not in rendered:
+            # A restored cache has only the gzipped bodies; the others are
+            # decompressed when first asked for.
+            content_type, body, etag = rendered[(use_openmetrics, True)]
+            rendered[(use_openmetrics, False)] = (
+                content_type,
+                gzip.decompress(body),
+                etag.replace("-gzip", ""),
+            )
+        return rendered[(use_openmetrics, use_gzip)]
+
+    def compressed(self):
+        """The gzipped bodies, which are all ``restore`` needs."""
+        return {key: value for key, value in self.rendered.items() if key[1]}
+
+    def restore(self, compressed):
+        self.rendered = dict(compressed)
+
+
+class RegistryCollector:
+    """Re-exports another registry, so each organization's registry carries the process metrics."""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def collect(self):
+        return self.registry.collect()
+
+
+def file_sd_targets(organizations):
+    """Render the organizations as a Prometheus file_sd YAML document."""
+    lines = []
+    for organization in organizations:
+        lines.append("- targets:")
+        lines.append(f"    - {json.dumps(organization.organization_id)}")
+        if organization.name:
+            lines.append("  labels:")
+            lines.append(f"    organizationName: {json.dumps(organization.name)}")
+    return "\n".join(lines) + "\n" if lines else "[]\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answers scrapes from the organizations' exposition caches, honouring If-None-Match.
+
+    ``/organizations`` lists the exported organizations in file_sd format and
+    ``/?target=<orgId>`` serves one organization; without a target the
+    organization given with ``-o`` is served. With ``--debug-endpoint`` the
+    ``/debug/`` paths profile an organization, see ``debug``.
+    """
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/organizations":
+            body = file_sd_targets(list(self.server.organizations.values())).encode()
+            self.send_body(body, "application/yaml; charset=utf-8")
+            return
+
+        query = urllib.parse.parse_qs(url.query)
+        organization = self.organization(query)
+        if organization is None:
+            return
+        if self.server.debug and url.path.startswith("/debug/"):
+            self.debug(url.path, query, organization)
+            return
+        organization.refresh_for_scrape()
+
+        use_openmetrics = any(
+            accepted.split(";")[0].strip() == "application/openmetrics-text"
+            for accepted in self.headers.get("Accept", "").split(",")
+        )
+        use_gzip = gzip_accepted(self.headers.get("Accept-Encoding"))
+        content_type, body, etag = organization.exposition.get(
+            use_openmetrics, use_gzip
+        )
+
+        if etag in (
+            tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")
+        ):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept, Accept-Encoding")
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def organization(self, query):
+        """The organization ``query`` targets, or None once the error is sent."""
+        target = query.get("target", [self.server.default_organization_id])[0]
+        if target is None:
+            self.send_error(400, "Missing target organization")
+            return None
+        organization = self.server.organizations.get(target)
+        if organization is None:
+            self.send_error(404, f"Unknown organization {target}")
+        return organization
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def debug(self, path, query, organization):
+        """Profile the organization on demand.
+
+        ``/debug/profile?cycles=N`` runs cProfile over its next N metric
+        updates and returns the stats (``sort`` and ``limit`` as pstats
+        takes them); ``/debug/memory?cycles=N`` returns the top allocators
+        with tracemalloc after its next metric update, and their growth over
+        the N updates after that; ``/debug/series`` returns the number of
+        series of every metric family as JSON. Waits up to ``timeout``
+        seconds for the updates, default 600.
+        """
+        try:
+            cycles = int(query.get("cycles", ["1"])[0])
+            limit = int(query.get("limit", ["40"])[0])
+            timeout = float(query.get("timeout", ["600"])[0])
+        except ValueError:
+            self.send_error(400, "cycles, limit and timeout must be numbers")
+            return
+        if not 1 <= cycles <= 100:
+            self.send_error(400, "cycles must be between 1 and 100")
+            return
+        if path != "/debug/series" and organization.loop is None:
+            self.send_error(503, "Collection has not started")
+            return
+
+        if path == "/debug/profile":
+            sort = query.get("sort", ["cumulative"])[0]
+            if sort not in pstats.Stats.sort_arg_dict_default:
+                self.send_error(400, f"Unknown sort key {sort}")
+                return
+            profile = organization.profile_updates(cycles, timeout)
+            if profile is None:
+                self.send_error(409, "Already profiling this organization")
+                return
+            report = io.StringIO()
+            try:
+                pstats.Stats(profile, stream=report).sort_stats(sort).print_stats(limit)
+            except TypeError:  # Nothing was profiled before the timeout
+                report.write("No metric updates profiled within the timeout\n")
+            self.send_body(report.getvalue().encode(), "text/plain; charset=utf-8")
+        elif path == "/debug/memory":
+            snapshots = organization.trace_updates(cycles, timeout)
+            if snapshots is None:
+                self.send_error(409, "Already profiling this organization")
+                return
+            self.send_body(memory_report(snapshots, limit).encode(), "text/plain; charset=utf-8")
+        elif path == "/debug/series":
+            body = json.dumps(organization.series_counts(), indent=2, sort_keys=True)
+            self.send_body(body.encode(), "application/json")
+        else:
+            self.send_error(404, "Unknown debug endpoint")
+
+    def log_message(self, format, *args):
+        """Log nothing."""
+
+
+# tracemalloc is process-wide, so memory probes of several organizations
+# share it: the first one starts it and the last one stops it, unless it was
+# already tracing before any of them.
+TRACEMALLOC_LOCK = threading.Lock()
+tracemalloc_users = 0
+tracemalloc_started = False
+
+
+def start_tracemalloc():
+    global tracemalloc_users, tracemalloc_started
+    with TRACEMALLOC_LOCK:
+        if tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            tracemalloc_started = True
+        tracemalloc_users += 1
+
+
+def stop_tracemalloc():
+    global tracemalloc_users, tracemalloc_started
+    with TRACEMALLOC_LOCK:
+        tracemalloc_users -= 1
+        if tracemalloc_users == 0 and tracemalloc_started:
+            tracemalloc.stop()
+            tracemalloc_started = False
+
+
+def memory_report(snapshots, limit):
+    """The top allocators of the first snapshot, and what grew by the last one, as text."""
+    if not snapshots:
+        return "No metric updates within the timeout\n"
+    # Leave out tracemalloc's own bookkeeping.
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    first = snapshots[0].filter_traces(ignored)
+    lines = [f"Top {limit} allocators after one update:"]
+    lines += [str(statistic) for statistic in first.statistics("lineno")[:limit]]
+    if len(snapshots) > 1:
+        last = snapshots[-1].filter_traces(ignored)
+        lines += ["", f"Top {limit} changes since then:"]
+        lines += [str(statistic) for statistic in last.compare_to(first, "lineno")[:limit]]
+    else:
+        lines += ["", "The following updates did not happen within the timeout, or the probe failed"]
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port, addr, organizations, default_organization_id=None, debug=False):
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    server.organizations = organizations
+    server.default_organization_id = default_organization_id
+    server.debug = debug
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
 
 
-REQUEST_TIME = Gauge("request_processing_seconds", "Time spent processing request")
 label_list = ["networkId", "networkName"]
-network_uplink_sent_metric = Gauge(
+network_uplink_sent_metric = MetricDefinition(
     "meraki_network_uplink_sent",
     "Network Uplink Sent Bytes (per minute)",
     label_list + ["uplink"],
 )
-network_uplink_received_metric = Gauge(
+network_uplink_received_metric = MetricDefinition(
     "meraki_network_uplink_received",
     "Network Uplink Received Bytes (per minute)",
     label_list + ["uplink"],
 )
-device_status_metric = Gauge(
+network_uplink_sent_bytes_metric = MetricDefinition(
+    "meraki_network_uplink_sent_bytes",
+    "Network Uplink Sent Bytes since the exporter started counting",
+    label_list + ["uplink"],
+    "counter",
+)
+network_uplink_received_bytes_metric = MetricDefinition(
+    "meraki_network_uplink_received_bytes",
+    "Network Uplink Received Bytes since the exporter started counting",
+    label_list + ["uplink"],
+    "counter",
+)
+device_status_metric = MetricDefinition(
     "meraki_device_status", "Device Status", label_list + ["serial", "deviceName"]
 )
-device_cellular_failover_metric = Gauge(
+device_cellular_failover_metric = MetricDefinition(
     "meraki_device_using_cellular_failover",
     "Cellular Failover",
     label_list + ["serial", "deviceName"],
 )
-device_uplink_latency_metric = Gauge(
+device_uplink_latency_metric = MetricDefinition(
     "meraki_device_uplink_latency",
     "Device Uplink Latency (seconds)",
     label_list + ["serial", "deviceName", "uplink"],
 )
-device_uplink_loss_metric = Gauge(
+device_uplink_loss_metric = MetricDefinition(
     "meraki_device_uplink_loss",
     "Device Uplink Loss (percent)",
     label_list + ["serial", "deviceName", "uplink"],
 )
+device_uplink_latency_window_metric = MetricDefinition(
+    "meraki_device_uplink_latency_window",
+    "Device Uplink Latency over the loss and latency window (seconds), by statistic",
+    label_list + ["serial", "deviceName", "uplink", "stat"],
+)
+device_uplink_loss_window_metric = MetricDefinition(
+    "meraki_device_uplink_loss_window",
+    "Device Uplink Loss over the loss and latency window (percent), by statistic",
+    label_list + ["serial", "deviceName", "uplink", "stat"],
+)
 
-device_uplink_status_metric = Gauge(
+device_uplink_status_metric = MetricDefinition(
     "meraki_device_uplink_status",
     "Device Uplink Status",
     label_list + ["serial", "deviceName", "uplink"],
 )
+MERAKI_METRICS = [
+    network_uplink_sent_metric,
+    network_uplink_received_metric,
+    network_uplink_sent_bytes_metric,
+    network_uplink_received_bytes_metric,
+    device_status_metric,
+    device_cellular_failover_metric,
+    device_uplink_latency_metric,
+    device_uplink_loss_metric,
+    device_uplink_latency_window_metric,
+    device_uplink_loss_window_metric,
+    device_uplink_status_metric,
+]
 
 
-@REQUEST_TIME.time()
-def update_metrics():
-    dashboard = meraki.DashboardAPI(API_KEY, base_url=API_URL, suppress_logging=True)
-    organization_id = ORG_ID
+UPLINK_STATUS_MAPPINGS = {
+    "active": 0,
+    "ready": 1,
+    "connecting": 2,
+    "not connected": 3,
+    "failed": 4,
+}
 
-    network_devices_dict = get_usage(dashboard, organization_id)
-    logging.debug(f"Reporting on: {len(network_devices_dict)} networks")
 
-    # uplink statuses
-    uplink_status_mappings = {
-        "active": 0,
-        "ready": 1,
-        "connecting": 2,
-        "not connected": 3,
-        "failed": 4,
-    }
+def publish_devices(series, inventory, devices_statuses):
+    for device in inventory.devices.values():
+        if device.labels is None:
+            continue
+        if device.status is not None:
+            series.set(
+                device_status_metric, device.labels, "1" if device.status == "online" else "0"
+            )
+        if device.using_cellular_failover is not None:
+            series.set(
+                device_cellular_failover_metric,
+                device.labels,
+                "1" if device.using_cellular_failover else "0",
+            )
+
+
+def publish_uplinks_loss_and_latency(series, inventory, uplink_loss_and_latency):
+    for (
+        network_id,
+        serial,
+        uplink_name,
+        latency,
+        latency_timestamp,
+        loss,
+        loss_timestamp,
+        latency_stats,
+        loss_stats,
+    ) in uplink_loss_and_latency or []:
+        device_labels = inventory.device_labels(network_id, serial)
+        if not uplink_name or device_labels is None:
+            continue
+        uplink_labels = device_labels + (uplink_name,)
+        if latency is not None:
+            series.set(device_uplink_latency_metric, uplink_labels, latency, latency_timestamp)
+        if loss is not None:
+            series.set(device_uplink_loss_metric, uplink_labels, loss, loss_timestamp)
+        if latency_stats is not None:
+            for stat, value in zip(WINDOW_STATS, latency_stats):
+                series.set(device_uplink_latency_window_metric, uplink_labels + (stat,), value)
+        if loss_stats is not None:
+            for stat, value in zip(WINDOW_STATS, loss_stats):
+                series.set(device_uplink_loss_window_metric, uplink_labels + (stat,), value)
+
+
+def publish_uplink_statuses(series, inventory, uplink_statuses):
+    for network_id, serial, uplink_name, status in uplink_statuses or []:
+        device_labels = inventory.device_labels(network_id, serial)
+        if uplink_name and device_labels is not None and status in UPLINK_STATUS_MAPPINGS:
+            series.set(
+                device_uplink_status_metric,
+                device_labels + (uplink_name,),
+                UPLINK_STATUS_MAPPINGS[status],
+            )
+
+
+def publish_uplink_usage(series, inventory, uplink_usages):
+    for network_id, interfaces in (uplink_usages or {}).items():
+        network_name = inventory.network_names.get(network_id)
+        if network_name is None:
+            # Not in the network list (yet), so there is no name to label it with.
+            continue
+        for uplink_name, uplink_details in interfaces.items():
+            uplink_labels = (network_id, network_name, uplink_name)
+            if "sent" in uplink_details:
+                series.set(network_uplink_sent_metric, uplink_labels, uplink_details["sent"])
+                series.set(
+                    network_uplink_received_metric, uplink_labels, uplink_details["received"]
+                )
+            if "sent_total" in uplink_details:
+                series.set(
+                    network_uplink_sent_bytes_metric, uplink_labels, uplink_details["sent_total"]
+                )
+                series.set(
+                    network_uplink_received_bytes_metric,
+                    uplink_labels,
+                    uplink_details["received_total"],
+                )
+
+
+# The publisher of each source's records and the metrics it owns. The
+# networks source has none of its own: its names label everything else.
+PUBLISHERS = {
+    "devices": (
+        publish_devices,
+        [device_status_metric, device_cellular_failover_metric],
+    ),
+    "uplinks_loss_and_latency": (
+        publish_uplinks_loss_and_latency,
+        [
+            device_uplink_latency_metric,
+            device_uplink_loss_metric,
+            device_uplink_latency_window_metric,
+            device_uplink_loss_window_metric,
+        ],
+    ),
+    "uplink_statuses": (publish_uplink_statuses, [device_uplink_status_metric]),
+    "uplink_usage": (
+        publish_uplink_usage,
+        [
+            network_uplink_sent_metric,
+            network_uplink_received_metric,
+            network_uplink_sent_bytes_metric,
+            network_uplink_received_bytes_metric,
+        ],
+    ),
+}
+
+
+def publish_metrics(series, inventory, results, sources=PUBLISHERS):
+    """Set the series of ``sources`` from their results, and expire theirs that were not set."""
+    series.begin_publish()
+    metrics = []
+    for source in sources:
+        publish, source_metrics = PUBLISHERS[source]
+        publish(series, inventory, results.get(source))
+        metrics += source_metrics
+    series.evict_stale(metrics)
+
+
+# Bumped whenever the shape of the cached source results changes.
+STATE_VERSION = 4
+
+
+class Organization:
+    """Collection and exposition state for one Meraki organization.
+
+    Each organization has its own API budget, scheduler, series and registry,
+    so several organizations can be collected concurrently by one exporter
+    and scraped independently.
+    """
+
+    def __init__(self, organization_id, name=None, api_rate=10, series_ttl=600):
+        self.organization_id = organization_id
+        self.name = name
+        self.registry = CollectorRegistry()
+        self.registry.register(RegistryCollector(REGISTRY))
+        self.rate_limiter = RateLimiter(api_rate, self.registry)
+        self.metrics = CollectionMetrics(self.registry)
+        self.request_time = Gauge(
+            "request_processing_seconds",
+            "Time spent processing request",
+            registry=self.registry,
+        )
+        self.series = SeriesTracker(series_ttl, self.registry)
+        self.inventory = None
+        self.snapshot = SnapshotCollector(MERAKI_METRICS)
+        self.registry.register(self.snapshot)
+        self.exposition = ExpositionCache(self.registry)
+        self.exposition.render()
+        self.scheduler = Scheduler(self.update_metrics, self.metrics)
+        self.usage_plan = UsagePlan(self.metrics)
+        self.usage_counters = UsageCounters()
+        self.loop = None
+        self.refreshed = None
+        self.refresh_task = None
+        self.render_task = None
+        self.render_pending = None
+        self.persist_pending = False
+        self.probe_lock = threading.Lock()
+
+    def update_metrics(self, source, results, updated_at=None):
+        """Republish the series of the source that refreshed.
+
+        The networks and devices are what everything is labelled with, so
+        when either changes a label every source is republished; otherwise
+        only the refreshed source's slice of the series is. A failed refresh,
+        reported with ``results`` None, republishes nothing and leaves the
+        snapshot timestamp alone; only the exporter's own metrics change.
+        """
+        if results is None:
+            self.schedule_render(source, False)
+            return
+        phase_duration = self.metrics.phase_duration
+        with self.request_time.time():
+            sources = [source] if source in PUBLISHERS else []
+            if source in ("networks", "devices", "restore") or self.inventory is None:
+                with phase_duration.labels("join", source).time():
+                    inventory = build_inventory(results.get("networks"), results.get("devices"))
+                logging.debug(
+                    f"Reporting on: {len(inventory.network_names)} networks "
+                    f"in organization {self.organization_id}"
+                )
+                if self.inventory is None or not inventory.same_labels(self.inventory):
+                    sources = PUBLISHERS
+                self.inventory = inventory
+                # Created since the network list was fetched, or it failed.
+                if (
+                    source == "devices"
+                    and inventory.unknown_networks
+                    and self.scheduler.refresh_early("networks")
+                ):
+                    logging.info(
+                        f"{len(inventory.unknown_networks)} networks of organization "
+                        f"{self.organization_id} are not in its network list, refreshing it"
+                    )
+            with phase_duration.labels("publish", source).time():
+                if sources:
+                    publish_metrics(self.series, self.inventory, results, sources)
+                    self.snapshot.publish(self.series.families())
+        self.metrics.snapshot_timestamp.set(updated_at or time.time())
+        self.schedule_render(source, STATE_DIR and updated_at is None)
+
+    def schedule_render(self, source, persist):
+        """Render the exposition after an update, and save the state if ``persist``."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.render(source)
+            if persist:
+                self.persist(source)
+            return
+        self.render_pending = source
+        self.persist_pending = self.persist_pending or persist
+        if self.render_task is None or self.render_task.done():
+            self.render_task = asyncio.create_task(self.render_in_executor())
+
+    def render(self, source):
+        with self.metrics.phase_duration.labels("render", source).time():
+            self.exposition.render()
+
+    def persist(self, source):
+        with self.metrics.phase_duration.labels("persist", source).time():
+            self.save_state()
+
+    async def render_in_executor(self):
+        """Render the exposition off the event loop, then save the state.
+
+        Updates that arrive while a render is running are coalesced into one
+        more render once it finishes.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while self.render_pending is not None:
+                source, self.render_pending = self.render_pending, None
+                await loop.run_in_executor(None, self.render, source)
+            if self.persist_pending:
+                self.persist_pending = False
+                self.persist(source)
+        except Exception:
+            logging.exception(
+                f"Rendering the metrics of organization {self.organization_id} failed"
+            )
+
+    def state_path(self):
+        if SHARD_COUNT == 1:
+            return os.path.join(STATE_DIR, f"{self.organization_id}.pickle")
+        # Shards may share a directory, and a resharded replica must not
+        # restore networks it no longer owns.
+        return os.path.join(
+            STATE_DIR, f"{self.organization_id}-shard{SHARD_INDEX}of{SHARD_COUNT}.pickle"
+        )
+
+    def save_state(self):
+        """Write the cached source results to ``--state-dir``, replacing the previous state atomically."""
+        state = {
+            "version": STATE_VERSION,
+            "saved_at": time.time(),
+            "name": self.name,
+            "results": self.scheduler.results,
+            "last_success": self.scheduler.last_success,
+            "exposition": self.exposition.compressed(),
+            "usage_counters": (self.usage_counters.totals, self.usage_counters.counted_until),
+        }
+        path = self.state_path()
+        try:
+            with open(f"{path}.tmp", "wb") as state_file:
+                pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{path}.tmp", path)
+        except OSError as error:
+            logging.warning(f"Could not save state of organization {self.organization_id}: {error}")
+
+    def load_state(self):
+        """Serve the metrics saved by a previous run until live refreshes replace them.
+
+        The exposition saved with the results is served as soon as it is read,
+        and the series are then rebuilt from the results so that later
+        refreshes join with them. Restored metrics carry the time they were
+        saved in meraki_exporter_snapshot_timestamp_seconds and in each
+        source's last success timestamp.
+        """
+        try:
+            with open(self.state_path(), "rb") as state_file:
+                state = pickle.load(state_file)
+        except FileNotFoundError:
+            return
+        except Exception as error:
+            logging.warning(f"Ignoring saved state of organization {self.organization_id}: {error}")
+            return
+        if state.get("version") != STATE_VERSION:
+            return
+        if self.name is None:
+            # Restored before the organization list has been fetched.
+            self.name = state.get("name")
+        # Serve what was last exported right away; rebuilding the series
+        # from the results takes longer.
+        self.exposition.restore(state["exposition"])
+        self.scheduler.results.update(state["results"])
+        self.usage_counters.totals, self.usage_counters.counted_until = state["usage_counters"]
+        self.scheduler.last_success.update(state["last_success"])
+        for source, timestamp in state["last_success"].items():
+            self.metrics.last_success.labels(source).set(timestamp)
+        self.update_metrics("restore", self.scheduler.results, state["saved_at"])
+        logging.info(
+            f"Restored organization {self.organization_id} as of "
+            f"{time.time() - state['saved_at']:.0f} seconds ago"
+        )
+
+    def refresh_for_scrape(self):
+        """Called from the HTTP server's thread before a scrape of this organization is answered.
+
+        With ``--scrape-ttl`` a scrape finding the metrics older than the TTL
+        refreshes the due sources on the collection loop and waits up to
+        ``--scrape-deadline`` for them; concurrent scrapes share one refresh.
+        A scrape that runs out of time gets the previous snapshot, whose age
+        shows in meraki_exporter_snapshot_timestamp_seconds.
+        """
+        if SCRAPE_TTL is None or self.loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self.refresh_if_stale(SCRAPE_TTL), self.loop)
+        try:
+            future.result(SCRAPE_DEADLINE)
+        except concurrent.futures.TimeoutError:
+            self.metrics.scrape_deadline_exceeded.inc()
+            logging.warning(
+                f"Refresh of organization {self.organization_id} missed the scrape deadline"
+            )
+        except Exception:
+            logging.exception(f"Refresh of organization {self.organization_id} failed")
+
+    async def refresh_if_stale(self, ttl):
+        if self.refresh_task is None or self.refresh_task.done():
+            if self.refreshed is not None and time.monotonic() - self.refreshed < ttl:
+                return
+            self.refresh_task = asyncio.create_task(self.refresh())
+        # A scrape giving up must not cancel the refresh the others wait on.
+        await asyncio.shield(self.refresh_task)
+
+    async def refresh(self):
+        start = time.monotonic()
+        await self.scheduler.refresh_due(CYCLE_BUDGET)
+        if self.render_task is not None:
+            # Answer the scrape waiting on this refresh with what it fetched.
+            await asyncio.shield(self.render_task)
+        self.refreshed = start
+
+    def probe_updates(self, cycles, wrap, timeout):
+        """Called from the HTTP server's thread: run the next ``cycles`` metric updates through ``wrap``.
+
+        ``wrap(update_metrics, source, results)`` stands in for the
+        scheduler's update hook until the updates are done or ``timeout``
+        passes, whichever is first; the rest of the time the hook is
+        ``update_metrics`` itself, so probes cost nothing until asked for.
+        Returns whether all the updates ran, or None if another probe of
+        this organization is running. A probe that raises is logged and
+        ends early, and the update it was wrapping still happens, so a
+        debug request can never stop collection.
+        """
+        if not self.probe_lock.acquire(blocking=False):
+            return None
+        try:
+            done = threading.Event()
+            expired = threading.Event()
+            remaining = cycles
+
+            def on_update(source, results):
+                nonlocal remaining
+                if expired.is_set():
+                    # Timed out, but updated before the hook was put back.
+                    self.update_metrics(source, results)
+                    return
+                updated = False
+
+                def update_metrics(source, results):
+                    nonlocal updated
+                    updated = True
+                    self.update_metrics(source, results)
+
+                try:
+                    wrap(update_metrics, source, results)
+                except Exception:
+                    logging.exception(
+                        f"Debug probe of organization {self.organization_id} failed"
+                    )
+                    self.scheduler.on_update = self.update_metrics
+                    expired.set()
+                    done.set()
+                    if not updated:
+                        self.update_metrics(source, results)
+                    return
+                remaining -= 1
+                if remaining == 0:
+                    self.scheduler.on_update = self.update_metrics
+                    done.set()
+
+            self.loop.call_soon_threadsafe(setattr, self.scheduler, "on_update", on_update)
+            if not done.wait(timeout) or expired.is_set():
+                expired.set()
+                self.loop.call_soon_threadsafe(
+                    setattr, self.scheduler, "on_update", self.update_metrics
+                )
+                return False
+            return True
+        finally:
+            self.probe_lock.release()
+
+    def profile_updates(self, cycles, timeout):
+        """cProfile the next ``cycles`` metric updates; the profile, or None if one is running."""
+        profile = cProfile.Profile()
 
-    for network_id, network_details in network_devices_dict.items():
-        network_name = network_details["name"]
-        if "interfaces" in network_details:
-            for uplink_name, uplink_details in network_details["interfaces"].items():
-                network_uplink_sent_metric.labels(
-                    network_id, network_name, uplink_name
-                ).set(uplink_details["sent"])
-
-                network_uplink_received_metric.labels(
-                    network_id, network_name, uplink_name
-                ).set(uplink_details["received"])
-
-        if "devices" in network_details:
-            for device_serial, device_details in network_details["devices"].items():
-                if "name" in device_details and device_details["name"]:
-                    device_name = device_details["name"]
+        def profiled(update_metrics, source, results):
+            profile.enable()
+            try:
+                update_metrics(source, results)
+            finally:
+                profile.disable()
+
+        if self.probe_updates(cycles, profiled, timeout) is None:
+            return None
+        return profile
+
+    def trace_updates(self, cycles, timeout):
+        """Snapshots of the memory allocated after the next metric update and ``cycles`` updates later.
+
+        tracemalloc runs only meanwhile, unless it was already tracing.
+        Returns None if another probe is running, and no second snapshot if
+        the updates did not all happen within ``timeout``.
+        """
+        snapshots = []
+
+        def traced(update_metrics, source, results):
+            update_metrics(source, results)
+            # Stopped if the probe timed out while this update ran.
+            if tracemalloc.is_tracing():
+                snapshots.append(tracemalloc.take_snapshot())
+
+        start_tracemalloc()
+        try:
+            if self.probe_updates(cycles + 1, traced, timeout) is None:
+                return None
+        finally:
+            stop_tracemalloc()
+        return snapshots[:1] + snapshots[-1:] if len(snapshots) > 1 else snapshots
+
+    def series_counts(self):
+        """The number of series of every metric family in this organization's registry."""
+        counts = {}
+        for family in self.registry.collect():
+            counts[family.name] = len(
+                {
+                    tuple(sorted(item for item in sample.labels.items() if item[0] != "le"))
+                    for sample in family.samples
+                }
+            )
+        return counts
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        if STATE_DIR:
+            self.load_state()
+        # Each organization gets its own client so every request it makes,
+        # pages and retries included, is charged to its own rate budget.
+        recorder = None
+        if RECORD_DIR:
+            recorder = ResponseRecorder(RECORD_DIR, self.organization_id, RECORD_ANONYMISED)
+            logging.info(f"Recording API responses to {recorder.path}")
+        try:
+            async with dashboard_api() as dashboard:
+                instrument_requests(dashboard, self.rate_limiter, self.metrics, recorder)
+                await self.collect(dashboard)
+        finally:
+            if recorder is not None:
+                recorder.close()
+
+    async def collect(self, dashboard):
+        organization_id = self.organization_id
+        scheduler = self.scheduler
+        scheduler.add_source(
+            "networks",
+            lambda: get_networks(dashboard, organization_id),
+            NETWORKS_INTERVAL,
+            NETWORKS_INTERVAL * JITTER,
+            timeout=NETWORKS_TIMEOUT,
+        )
+        scheduler.add_source(
+            "devices",
+            lambda: get_devices(dashboard, organization_id),
+            DEVICES_INTERVAL,
+            DEVICES_INTERVAL * JITTER,
+            timeout=DEVICES_TIMEOUT,
+        )
+        scheduler.add_source(
+            "uplinks_loss_and_latency",
+            lambda: get_uplinks_loss_and_latency(dashboard, organization_id),
+            LOSS_AND_LATENCY_INTERVAL,
+            LOSS_AND_LATENCY_INTERVAL * JITTER,
+            timeout=LOSS_AND_LATENCY_TIMEOUT,
+        )
+        scheduler.add_source(
+            "uplink_statuses",
+            lambda: get_uplink_statuses(dashboard, organization_id),
+            UPLINK_STATUSES_INTERVAL,
+            UPLINK_STATUSES_INTERVAL * JITTER,
+            timeout=UPLINK_STATUSES_TIMEOUT,
+        )
+        scheduler.add_source(
+            "uplink_usage",
+            lambda: get_uplink_usages(
+                dashboard,
+                organization_id,
+                self.usage_plan(scheduler.results),
+                API_CONCURRENCY,
+                USAGE_MODE,
+                USAGE_TIMESPAN,
+                self.usage_counters,
+                # Twice the interval, so a late poll still overlaps the last one.
+                max(600, int(USAGE_INTERVAL) * 2),
+                # Networks whose request fails keep their previous usage.
+                scheduler.results.get("uplink_usage"),
+            ),
+            USAGE_INTERVAL,
+            USAGE_INTERVAL * JITTER,
+            # Per-network usage is planned from the networks and devices.
+            after=("networks", "devices"),
+            timeout=USAGE_TIMEOUT,
+        )
+        if SCRAPE_TTL is None:
+            await scheduler.run()
+        else:
+            # Collect once up front, then only when scraped. Scrapes arriving
+            # meanwhile wait on this refresh instead of starting another.
+            self.refresh_task = asyncio.create_task(self.refresh())
+            await self.refresh_task
+            await asyncio.Event().wait()
+
+
+# First delay before discovery is retried after a failure; see discover_organizations.
+DISCOVERY_RETRY_DELAY = 5
+
+
+def saved_organizations():
+    """The IDs of the organizations whose state this replica saved in ``--state-dir``."""
+    if SHARD_COUNT == 1:
+        pattern = re.compile(r"(?!.*-shard\d+of\d+\.pickle$)(.+)\.pickle")
+    else:
+        pattern = re.compile(rf"(.+)-shard{SHARD_INDEX}of{SHARD_COUNT}\.pickle")
+    try:
+        filenames = sorted(os.listdir(STATE_DIR))
+    except OSError as error:
+        logging.warning(f"Could not list saved states: {error}")
+        return []
+    return [match[1] for match in map(pattern.fullmatch, filenames) if match]
+
+
+async def discover_organizations(dashboard, organizations, interval, workers=None):
+    """Keep one collection worker running for every organization the API key can see.
+
+    The organizations are listed again every ``interval`` seconds, or as soon
+    as a worker dies. While listing them fails or workers keep dying, it is
+    retried after a short delay that doubles up to ``interval``. ``workers``
+    are already running for ``organizations`` restored from saved state;
+    they are kept if the organization is still listed.
+    """
+    workers = dict(workers or {})
+    retry_delay = DISCOVERY_RETRY_DELAY
+    while True:
+        failed = False
+        try:
+            available = await dashboard.organizations.getOrganizations()
+        except API_ERRORS as api_error:
+            logging.warning(api_error)
+            available = None
+            failed = True
+
+        if available is not None:
+            names = {
+                organization["id"]: organization.get("name")
+                for organization in available
+                if organization.get("api", {}).get("enabled", True)
+            }
+            for organization_id in list(workers):
+                if organization_id not in names:
+                    logging.info(f"No longer exporting organization {organization_id}")
+                    workers.pop(organization_id).cancel()
+                    del organizations[organization_id]
+            for organization_id, name in names.items():
+                worker = workers.get(organization_id)
+                if worker is not None and worker.done() and not worker.cancelled():
+                    logging.error(
+                        f"Collection for organization {organization_id} stopped, restarting",
+                        exc_info=worker.exception(),
+                    )
+                    worker = None
+                    failed = True
+                if worker is not None:
+                    organizations[organization_id].name = name
                 else:
-                    device_name = device_details["mac"]
-
-                if "status" in device_details:
-                    device_status_metric.labels(
-                        network_id, network_name, device_serial, device_name
-                    ).set("1" if device_details["status"] == "online" else "0")
-
-                if "usingCellularFailover" in device_details:
-                    device_cellular_failover_metric.labels(
-                        network_id, network_name, device_serial, device_name
-                    ).set("1" if device_details["usingCellularFailover"] else "0")
-
-                if "uplinks" in device_details:
-                    for uplink_name, uplink_details in device_details[
-                        "uplinks"
-                    ].items():
-                        if "status" in uplink_details:
-                            device_uplink_status_metric.labels(
-                                network_id,
-                                network_name,
-                                device_serial,
-                                device_name,
-                                uplink_name,
-                            ).set(uplink_status_mappings[uplink_details["status"]])
-                        if "latency" in uplink_details:
-                            device_uplink_latency_metric.labels(
-                                network_id,
-                                network_name,
-                                device_serial,
-                                device_name,
-                                uplink_name,
-                            ).set(uplink_details["latency"])
-                        if "loss" in uplink_details:
-                            device_uplink_loss_metric.labels(
-                                network_id,
-                                network_name,
-                                device_serial,
-                                device_name,
-                                uplink_name,
-                            ).set(uplink_details["loss"])
+                    logging.info(f"Exporting organization {organization_id} ({name})")
+                    organization = Organization(
+                        organization_id, name, API_RATE, SERIES_TTL
+                    )
+                    organizations[organization_id] = organization
+                    workers[organization_id] = asyncio.create_task(organization.run())
+
+        if failed:
+            await asyncio.sleep(min(retry_delay, interval))
+            retry_delay *= 2
+            continue
+        retry_delay = DISCOVERY_RETRY_DELAY
+        running = [worker for worker in workers.values() if not worker.done()]
+        if running:
+            # Wakes early if a worker dies.
+            await asyncio.wait(running, timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            await asyncio.sleep(interval)
+
+
+def import_sdk():
+    global API_ERRORS
+    import meraki
+    import meraki.aio
+
+    # meraki<2 raises AsyncAPIError from the asyncio client, later releases raise APIError
+    API_ERRORS = (DashboardAPIError, meraki.APIError, meraki.AsyncAPIError)
+    return meraki
+
+
+def dashboard_api():
+    # Each client lives for the life of its worker, so its connection pool is reused across cycles.
+    if API_CLIENT == "builtin":
+        return DashboardClient(API_KEY, API_URL, API_CONCURRENCY)
+    meraki = import_sdk()
+    return meraki.aio.AsyncDashboardAPI(
+        API_KEY,
+        base_url=API_URL,
+        suppress_logging=True,
+        maximum_concurrent_requests=API_CONCURRENCY,
+        use_iterator_for_get_pages=True,
+    )
+
+
+async def main():
+    if ORG_ID:
+        await ORGANIZATIONS[ORG_ID].run()
+    else:
+        workers = {}
+        if STATE_DIR:
+            # Serve what was saved while the organizations are listed.
+            for organization_id in saved_organizations():
+                logging.info(f"Restoring organization {organization_id}")
+                organization = Organization(organization_id, None, API_RATE, SERIES_TTL)
+                ORGANIZATIONS[organization_id] = organization
+                workers[organization_id] = asyncio.create_task(organization.run())
+        async with dashboard_api() as dashboard:
+            await discover_organizations(
+                dashboard, ORGANIZATIONS, ORGANIZATIONS_INTERVAL, workers
+            )
 
 
 if __name__ == "__main__":
@@ -311,20 +2636,271 @@ if __name__ == "__main__":
         "-o",
         metavar="ORG_ID",
         type=str,
-        required=True,
         env_var="MERAKI_ORG_ID",
-        help="The Meraki API Organization ID",
+        help="The Meraki API Organization ID. If omitted, every organization the API key "
+        "can access is exported, selected with the target URL parameter",
+    )
+    parser.add_argument(
+        "--concurrency",
+        metavar="WORKERS",
+        type=int,
+        default=8,
+        env_var="MERAKI_API_CONCURRENCY",
+        help="Maximum number of concurrent API requests, default 8",
+    )
+    parser.add_argument(
+        "--api-rate",
+        metavar="REQUESTS_PER_SECOND",
+        type=float,
+        default=10,
+        env_var="MERAKI_API_RATE",
+        help="Per-organization API request budget in requests per second, default 10",
+    )
+    parser.add_argument(
+        "--api-client",
+        choices=["sdk", "builtin"],
+        default="sdk",
+        env_var="MERAKI_API_CLIENT",
+        help="Call the API with the meraki SDK (sdk) or the exporter's own lean client "
+        "for just the endpoints it uses (builtin), default sdk",
+    )
+    parser.add_argument(
+        "--usage-mode",
+        choices=["bulk", "per-network"],
+        default="bulk",
+        env_var="MERAKI_USAGE_MODE",
+        help="Collect uplink usage with one organization-wide request (bulk) or one "
+        "request per network (per-network), default bulk. Bulk mode falls back to "
+        "per-network requests if the organization-wide endpoint fails",
+    )
+    parser.add_argument(
+        "--usage-timespan",
+        metavar="SECONDS",
+        type=int,
+        default=60,
+        help="Timespan requested from the bulk uplink usage endpoint, default 60",
+    )
+    parser.add_argument(
+        "--networks-interval",
+        metavar="SECONDS",
+        type=float,
+        default=3600,
+        help="How often to refresh the network list, default 3600",
+    )
+    parser.add_argument(
+        "--devices-interval",
+        metavar="SECONDS",
+        type=float,
+        default=30,
+        help="How often to refresh device statuses, default 30",
+    )
+    parser.add_argument(
+        "--loss-latency-interval",
+        metavar="SECONDS",
+        type=float,
+        default=60,
+        help="How often to refresh uplink loss and latency, default 60",
+    )
+    parser.add_argument(
+        "--uplink-statuses-interval",
+        metavar="SECONDS",
+        type=float,
+        default=60,
+        help="How often to refresh uplink statuses, default 60",
+    )
+    parser.add_argument(
+        "--usage-interval",
+        metavar="SECONDS",
+        type=float,
+        default=60,
+        help="How often to refresh uplink usage, default 60",
+    )
+    parser.add_argument(
+        "--jitter",
+        metavar="FRACTION",
+        type=float,
+        default=0.1,
+        help="Random delay added to each poll, as a fraction of the source's interval, default 0.1",
+    )
+    parser.add_argument(
+        "--series-ttl",
+        metavar="SECONDS",
+        type=float,
+        default=600,
+        help="Stop exporting series that have not been refreshed for this long, default 600",
+    )
+    parser.add_argument(
+        "--organizations-interval",
+        metavar="SECONDS",
+        type=float,
+        default=3600,
+        help="How often to refresh the organization list when -o is not given, default 3600",
+    )
+    parser.add_argument(
+        "--scrape-ttl",
+        metavar="SECONDS",
+        type=float,
+        help="Collect when scraped instead of on a timer, refreshing the sources due "
+        "(see the intervals) when the metrics are older than this",
+    )
+    parser.add_argument(
+        "--scrape-deadline",
+        metavar="SECONDS",
+        type=float,
+        default=10,
+        help="How long a scrape waits for the refresh it triggered before getting "
+        "the previous metrics, default 10",
+    )
+    parser.add_argument(
+        "--source-timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Abandon a refresh of any data source that takes longer than this and "
+        "keep exporting its previous data",
+    )
+    parser.add_argument(
+        "--networks-timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Abandon a refresh of the network list that takes longer than this, "
+        "default --source-timeout",
+    )
+    parser.add_argument(
+        "--devices-timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Abandon a refresh of device statuses that takes longer than this, "
+        "default --source-timeout",
+    )
+    parser.add_argument(
+        "--loss-latency-timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Abandon a refresh of uplink loss and latency that takes longer than this, "
+        "default --source-timeout",
+    )
+    parser.add_argument(
+        "--uplink-statuses-timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Abandon a refresh of uplink statuses that takes longer than this, "
+        "default --source-timeout",
+    )
+    parser.add_argument(
+        "--usage-timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Abandon a refresh of uplink usage that takes longer than this, "
+        "default --source-timeout",
+    )
+    parser.add_argument(
+        "--cycle-budget",
+        metavar="SECONDS",
+        type=float,
+        help="With --scrape-ttl, the most a refresh of all the due sources may take; "
+        "sources that run out of it keep their previous data",
+    )
+    parser.add_argument(
+        "--state-dir",
+        metavar="DIR",
+        help="Save the collected data here after every refresh and serve it straight "
+        "away on the next start, until the first refresh completes",
+    )
+    parser.add_argument(
+        "--debug-endpoint",
+        action="store_true",
+        help="Serve /debug/profile, /debug/memory and /debug/series next to the metrics, "
+        "to profile collection on demand; only on a trusted network",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="DIR",
+        help="Save every Dashboard API response to a gzipped file per organization in "
+        "this directory, for mock_api/replay_server.py",
+    )
+    parser.add_argument(
+        "--record-anonymised",
+        action="store_true",
+        help="Replace names, identifiers and addresses in the recorded responses",
+    )
+    parser.add_argument(
+        "--shard-count",
+        metavar="REPLICAS",
+        type=int,
+        default=1,
+        help="Split the networks of each organization between this many exporters, default 1",
+    )
+    parser.add_argument(
+        "--shard-index",
+        metavar="INDEX",
+        type=int,
+        default=0,
+        help="Which of the --shard-count shards this exporter exports, from 0, default 0",
+    )
+    parser.add_argument(
+        "--loss-latency-window",
+        metavar="SECONDS",
+        type=int,
+        help="Request this much uplink loss and latency history, at most 300, and also export "
+        "its min, max, mean and 95th percentile; pair with a longer --loss-latency-interval",
+    )
+    parser.add_argument(
+        "--loss-latency-timestamps",
+        action="store_true",
+        help="Export uplink loss and latency with the timestamps of their samples",
     )
     args = vars(parser.parse_args())
+    if args["shard_count"] < 1 or not 0 <= args["shard_index"] < args["shard_count"]:
+        parser.error("--shard-index must be at least 0 and less than --shard-count")
+    if args["loss_latency_window"] is not None and not 0 < args["loss_latency_window"] <= 300:
+        # The API refuses a longer timespan for loss and latency.
+        parser.error("--loss-latency-window must be between 1 and 300 seconds")
     HTTP_PORT_NUMBER = args["p"]
     HTTP_BIND_IP = args["i"]
     API_KEY = args["k"]
     API_URL = args["m"]
     ORG_ID = args["o"]
+    API_CONCURRENCY = args["concurrency"]
+    API_RATE = args["api_rate"]
+    API_CLIENT = args["api_client"]
+    USAGE_MODE = args["usage_mode"]
+    USAGE_TIMESPAN = args["usage_timespan"]
+    NETWORKS_INTERVAL = args["networks_interval"]
+    DEVICES_INTERVAL = args["devices_interval"]
+    LOSS_AND_LATENCY_INTERVAL = args["loss_latency_interval"]
+    UPLINK_STATUSES_INTERVAL = args["uplink_statuses_interval"]
+    USAGE_INTERVAL = args["usage_interval"]
+    JITTER = args["jitter"]
+    SERIES_TTL = args["series_ttl"]
+    ORGANIZATIONS_INTERVAL = args["organizations_interval"]
+    SCRAPE_TTL = args["scrape_ttl"]
+    SCRAPE_DEADLINE = args["scrape_deadline"]
+    SOURCE_TIMEOUT = args["source_timeout"]
+    # Each source's own timeout, if given, replaces --source-timeout.
+    NETWORKS_TIMEOUT = args["networks_timeout"] or SOURCE_TIMEOUT
+    DEVICES_TIMEOUT = args["devices_timeout"] or SOURCE_TIMEOUT
+    LOSS_AND_LATENCY_TIMEOUT = args["loss_latency_timeout"] or SOURCE_TIMEOUT
+    UPLINK_STATUSES_TIMEOUT = args["uplink_statuses_timeout"] or SOURCE_TIMEOUT
+    USAGE_TIMEOUT = args["usage_timeout"] or SOURCE_TIMEOUT
+    CYCLE_BUDGET = args["cycle_budget"]
+    STATE_DIR = args["state_dir"]
+    DEBUG_ENDPOINT = args["debug_endpoint"]
+    RECORD_DIR = args["record"]
+    RECORD_ANONYMISED = args["record_anonymised"]
+    SHARD_COUNT = args["shard_count"]
+    SHARD_INDEX = args["shard_index"]
+    LOSS_AND_LATENCY_WINDOW = args["loss_latency_window"]
+    LOSS_AND_LATENCY_TIMESTAMPS = args["loss_latency_timestamps"]
+    if STATE_DIR:
+        os.makedirs(STATE_DIR, exist_ok=True)
+    if RECORD_DIR:
+        os.makedirs(RECORD_DIR, exist_ok=True)
+
+    ORGANIZATIONS = {}
+    if ORG_ID:
+        ORGANIZATIONS[ORG_ID] = Organization(ORG_ID, None, API_RATE, SERIES_TTL)
 
     # Start up the server to expose the metrics.
-    start_http_server(HTTP_PORT_NUMBER, addr=HTTP_BIND_IP)
+    start_metrics_server(HTTP_PORT_NUMBER, HTTP_BIND_IP, ORGANIZATIONS, ORG_ID, DEBUG_ENDPOINT)
 
-    while True:
-        update_metrics()
-        time.sleep(30)
+    asyncio.run(main())
@@ -1,26 +1,57 @@
-from flask import Flask
+"""Mock of the Meraki Dashboard API endpoints the exporter calls.
 
-app = Flask(__name__)
+By default it serves the small fixture organization the integration tests
+expect. With ``--networks``/``--devices`` it serves a seeded synthetic
+organization of that size instead, with Link header pagination, optional
+per-request latency and random 429s, for benchmarking the exporter at scale.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
 
+from flask import Flask, Response, jsonify, request
 
-@app.route("/")
-def root():
-    return "Herp derp I'm an API"
+app = Flask(__name__)
 
+ORGANIZATION_ID = "1234"
 
-@app.route("/api/v1/organizations/1234/networks")
-def get_organization_networks():
-    return """[
+ORGANIZATIONS = """[
   {
-    "id": "N_24329156",
-    "name": "My network"
+    "id": "1234",
+    "name": "My organization",
+    "api": {
+      "enabled": true
+    }
+  },
+  {
+    "id": "5678",
+    "name": "API disabled organization",
+    "api": {
+      "enabled": false
+    }
   }
 ]"""
 
+NETWORKS = """[
+  {
+    "id": "N_24329156",
+    "name": "My network",
+    "enrollmentString": "my-enrollment-string"
+  },
+  {
+    "id": "N_83920581",
+    "name": "My wireless network",
+    "productTypes": ["wireless"]
+  }
+]"""
 
-@app.route("/api/v1/organizations/1234/apiRequests/overview")
-def get_organization_api_requests_overview():
-    return """{
+API_REQUESTS_OVERVIEW = """{
     "responseCodeCounts": {
         "200": 50000,
         "201": 4000,
@@ -31,10 +62,7 @@ def get_organization_api_requests_overview():
     }
 }"""
 
-
-@app.route("/api/v1/organizations/1234/devices/statuses")
-def get_organization_devices_statuses():
-    return """[
+DEVICES_STATUSES = """[
     {
         "name": "My AP",
         "serial": "Q234-ABCD-5678",
@@ -54,10 +82,7 @@ def get_organization_devices_statuses():
     }
 ]"""
 
-
-@app.route("/api/v1/organizations/1234/devices/uplinksLossAndLatency")
-def get_organization_devices_uplinks_loss_and_latency():
-    return """[
+UPLINKS_LOSS_AND_LATENCY = """[
     {
         "networkId": "N_24329156",
         "serial": "Q234-ABCD-5678",
@@ -86,10 +111,7 @@ def get_organization_devices_uplinks_loss_and_latency():
     }
 ]"""
 
-
-@app.route("/api/v1/organizations/1234/appliance/uplink/statuses")
-def get_organization_devices_uplink_statuses():
-    return """[
+UPLINK_STATUSES = """[
     {
         "networkId": "N_24329156",
         "serial": "Q234-ABCD-5678",
@@ -125,11 +147,10 @@ def get_organization_devices_uplink_statuses():
     }
 ]"""
 
-
-@app.route("/api/v1/networks/N_24329156/appliance/uplinks/usageHistory")
-def get_organization_network_uplink_usage():
-    return """[
+UPLINKS_USAGE_HISTORY = """[
     {
+        "startTime": "2019-01-31T18:45:00Z",
+        "endTime": "2019-01-31T18:46:00Z",
         "byInterface": [
             {
                 "interface": "wan1",
@@ -145,6 +166,398 @@ def get_organization_network_uplink_usage():
     }
 ]"""
 
+UPLINKS_USAGE_BY_NETWORK = """[
+    {
+        "networkId": "N_24329156",
+        "name": "My network",
+        "byUplink": [
+            {
+                "serial": "Q234-ABCD-5678",
+                "interface": "wan1",
+                "sent": 1111,
+                "received": 2222
+            },
+            {
+                "serial": "Q234-ABCD-5678",
+                "interface": "cellular",
+                "sent": 3333,
+                "received": 4444
+            }
+        ]
+    }
+]"""
+
+
+class FixtureDataset:
+    """The small organization the integration tests expect: one device, and a wireless-only network."""
+
+    def __init__(self):
+        self.networks = json.loads(NETWORKS)
+        self.devices_statuses = json.loads(DEVICES_STATUSES)
+        self.uplink_statuses = json.loads(UPLINK_STATUSES)
+
+    def uplinks_loss_and_latency(self, timespan):
+        return json.loads(UPLINKS_LOSS_AND_LATENCY)
+
+    def uplinks_usage_by_network(self, timespan):
+        return json.loads(UPLINKS_USAGE_BY_NETWORK)
+
+    def uplinks_usage_history(self, network_id, timespan, resolution):
+        if network_id != "N_24329156":
+            return None
+        return json.loads(UPLINKS_USAGE_HISTORY)
+
+
+def noise(*key):
+    """A stable pseudo-random fraction in [0, 1) for ``key``."""
+    return zlib.crc32(":".join(map(str, key)).encode()) / 2**32
+
+
+def iso_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class SyntheticDataset:
+    """A seeded organization of ``network_count`` networks and ``device_count`` devices.
+
+    Every network gets a device before any gets a second one, and every
+    network with the appliance product type gets an MX as its first device.
+    Time series are generated per request from stable noise keyed by the
+    bucket timestamp, so overlapping requests agree on overlapping buckets.
+    """
+
+    PRODUCT_TYPES = [
+        ["appliance", "switch", "wireless"],
+        ["appliance", "wireless"],
+        ["appliance"],
+        ["switch", "wireless"],
+        ["wireless"],
+    ]
+    MODELS = {"appliance": "MX68", "switch": "MS120-8", "wireless": "MR36"}
+
+    def __init__(self, network_count, device_count, seed=1):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.networks = []
+        for index in range(network_count):
+            self.networks.append(
+                {
+                    "id": f"N_{index:08d}",
+                    "organizationId": ORGANIZATION_ID,
+                    "name": f"Network {index}",
+                    "productTypes": rng.choice(self.PRODUCT_TYPES),
+                    "timeZone": "Etc/UTC",
+                    "tags": [],
+                }
+            )
+
+        self.devices_statuses = []
+        self.appliances = []
+        for index in range(device_count):
+            if index < network_count:
+                network = self.networks[index]
+                product_type = network["productTypes"][0]
+            else:
+                network = rng.choice(self.networks)
+                product_type = rng.choice(
+                    [t for t in network["productTypes"] if t != "appliance"]
+                    or network["productTypes"]
+                )
+            device = {
+                "name": f"Device {index}",
+                "serial": f"Q{index:011d}",
+                "mac": ":".join(f"{(index >> shift) & 0xFF:02x}" for shift in range(40, -8, -8)),
+                "publicIp": f"203.0.{index >> 8 & 0xFF}.{index & 0xFF}",
+                "networkId": network["id"],
+                "status": rng.choices(["online", "offline", "alerting", "dormant"], [90, 5, 4, 1])[
+                    0
+                ],
+                "lastReportedAt": "2018-02-11T00:00:00.090210Z",
+                "lanIp": f"10.{index >> 16 & 0xFF}.{index >> 8 & 0xFF}.{index & 0xFF}",
+                "gateway": "10.0.0.1",
+                "ipType": "dhcp",
+                "primaryDns": "8.8.8.8",
+                "secondaryDns": "8.8.4.4",
+                "productType": product_type,
+                "model": self.MODELS[product_type],
+                "tags": [],
+                "components": {"powerSupplies": []},
+            }
+            if product_type == "appliance":
+                device["usingCellularFailover"] = rng.random() < 0.02
+                self.appliances.append(device)
+            self.devices_statuses.append(device)
+
+        self.uplink_statuses = [
+            {
+                "networkId": device["networkId"],
+                "serial": device["serial"],
+                "model": device["model"],
+                "lastReportedAt": "2018-02-11T00:00:00Z",
+                "uplinks": [
+                    {"interface": "wan1", "status": "active", "ip": device["lanIp"]},
+                    {
+                        "interface": "wan2",
+                        "status": rng.choices(["ready", "failed", "not connected"], [80, 5, 15])[
+                            0
+                        ],
+                        "ip": device["lanIp"],
+                    },
+                    {"interface": "cellular", "status": "ready", "provider": "at&t"},
+                ],
+            }
+            for device in self.appliances
+        ]
+
+    def buckets(self, timespan, resolution):
+        end = int(time.time()) // resolution * resolution
+        return range(end - int(timespan), end, resolution)
+
+    def uplinks_loss_and_latency(self, timespan):
+        buckets = self.buckets(timespan, 60)
+        result = []
+        for device in self.appliances:
+            for uplink in ("wan1", "wan2"):
+                key = (self.seed, device["serial"], uplink)
+                result.append(
+                    {
+                        "networkId": device["networkId"],
+                        "serial": device["serial"],
+                        "uplink": uplink,
+                        "ip": "8.8.8.8",
+                        "timeSeries": [
+                            {
+                                "ts": iso_timestamp(ts),
+                                "lossPercent": round(noise(*key, "loss", ts) * 2, 1),
+                                "latencyMs": round(10 + noise(*key, "latency", ts) * 90, 1),
+                            }
+                            for ts in buckets
+                        ],
+                    }
+                )
+        return result
+
+    def usage(self, network_id, interface, start, end):
+        """Bytes sent and received by ``interface`` of ``network_id`` over whole minutes in [start, end)."""
+        sent = received = 0
+        for ts in range(start, end, 60):
+            sent += int(noise(self.seed, network_id, interface, "sent", ts) * 10_000_000)
+            received += int(noise(self.seed, network_id, interface, "received", ts) * 50_000_000)
+        return sent, received
+
+    def uplinks_usage_by_network(self, timespan):
+        buckets = self.buckets(timespan, 60)
+        result = []
+        for device in self.appliances:
+            by_uplink = []
+            for interface in ("wan1", "wan2"):
+                sent, received = self.usage(
+                    device["networkId"], interface, buckets.start, buckets.stop
+                )
+                by_uplink.append(
+                    {
+                        "serial": device["serial"],
+                        "interface": interface,
+                        "sent": sent,
+                        "received": received,
+                    }
+                )
+            result.append(
+                {"networkId": device["networkId"], "name": device["networkId"], "byUplink": by_uplink}
+            )
+        return result
+
+    def uplinks_usage_history(self, network_id, timespan, resolution):
+        if not any(device["networkId"] == network_id for device in self.appliances):
+            return None
+        result = []
+        for ts in self.buckets(timespan, resolution):
+            by_interface = []
+            for interface in ("wan1", "wan2"):
+                sent, received = self.usage(network_id, interface, ts, ts + resolution)
+                by_interface.append({"interface": interface, "sent": sent, "received": received})
+            result.append(
+                {
+                    "startTime": iso_timestamp(ts),
+                    "endTime": iso_timestamp(ts + resolution),
+                    "byInterface": by_interface,
+                }
+            )
+        return result
+
+
+DATASET = FixtureDataset()
+LATENCY = 0.0
+RATE_LIMIT_PROBABILITY = 0.0
+PAGE_SIZE = 1000
+FAIL_NETWORKS = 0
+DROP_UPLINK_AFTER = 0
+CALLS = Counter()
+CALLS_LOCK = threading.Lock()
+
+
+def paginated(items):
+    """Return one page of ``items`` with a Link header to the next, like the Dashboard API.
+
+    ``startingAfter`` is an opaque cursor to the client; here it is the offset.
+    """
+    per_page = min(int(request.args.get("perPage", PAGE_SIZE)), PAGE_SIZE)
+    start = int(request.args.get("startingAfter", 0))
+    response = Response(json.dumps(items[start : start + per_page]), mimetype="application/json")
+    if start + per_page < len(items):
+        query = dict(request.args)
+        query["startingAfter"] = start + per_page
+        query["perPage"] = per_page
+        next_url = f"{request.base_url}?{urllib.parse.urlencode(query)}"
+        response.headers["Link"] = f"<{next_url}>; rel=next"
+    return response
+
+
+def check_organization(organization_id):
+    if organization_id != ORGANIZATION_ID:
+        return Response(json.dumps({"errors": ["Not found"]}), status=404)
+
+
+@app.before_request
+def simulate_dashboard():
+    if not request.path.startswith("/api/"):
+        return None
+    with CALLS_LOCK:
+        CALLS[request.path] += 1
+    if LATENCY:
+        time.sleep(LATENCY)
+    if RATE_LIMIT_PROBABILITY and random.random() < RATE_LIMIT_PROBABILITY:
+        with CALLS_LOCK:
+            CALLS["429"] += 1
+        return Response(
+            json.dumps({"errors": ["API rate limit exceeded for organization"]}),
+            status=429,
+            headers={"Retry-After": "1"},
+        )
+    return None
+
+
+@app.route("/")
+def root():
+    return "Herp derp I'm an API"
+
+
+@app.route("/_stats")
+def stats():
+    with CALLS_LOCK:
+        calls = dict(CALLS)
+    rate_limited = calls.pop("429", 0)
+    return jsonify(
+        {"requests": calls, "total": sum(calls.values()), "rate_limited": rate_limited}
+    )
+
+
+@app.route("/api/v1/organizations")
+def get_organizations():
+    return ORGANIZATIONS
+
+
+@app.route("/api/v1/organizations/<organization_id>/networks")
+def get_organization_networks(organization_id):
+    with CALLS_LOCK:
+        failing = CALLS[request.path] <= FAIL_NETWORKS
+    if failing:
+        return Response(json.dumps({"errors": ["Internal server error"]}), status=500)
+    return check_organization(organization_id) or paginated(DATASET.networks)
+
+
+@app.route("/api/v1/organizations/<organization_id>/apiRequests/overview")
+def get_organization_api_requests_overview(organization_id):
+    return check_organization(organization_id) or API_REQUESTS_OVERVIEW
+
+
+@app.route("/api/v1/organizations/<organization_id>/devices/statuses")
+def get_organization_devices_statuses(organization_id):
+    return check_organization(organization_id) or paginated(DATASET.devices_statuses)
+
+
+@app.route("/api/v1/organizations/<organization_id>/devices/uplinksLossAndLatency")
+def get_organization_devices_uplinks_loss_and_latency(organization_id):
+    timespan = int(request.args.get("timespan", 300))
+    return check_organization(organization_id) or jsonify(
+        DATASET.uplinks_loss_and_latency(timespan)
+    )
+
+
+@app.route("/api/v1/organizations/<organization_id>/appliance/uplink/statuses")
+def get_organization_devices_uplink_statuses(organization_id):
+    with CALLS_LOCK:
+        dropped = DROP_UPLINK_AFTER and CALLS[request.path] > DROP_UPLINK_AFTER
+    uplink_statuses = DATASET.uplink_statuses
+    if dropped:
+        uplink_statuses = [
+            dict(
+                device,
+                uplinks=[uplink for uplink in device["uplinks"] if uplink["interface"] != "cellular"],
+            )
+            for device in uplink_statuses
+        ]
+    return check_organization(organization_id) or paginated(uplink_statuses)
+
+
+@app.route("/api/v1/networks/<network_id>/appliance/uplinks/usageHistory")
+def get_organization_network_uplink_usage(network_id):
+    timespan = int(request.args.get("timespan", 600))
+    resolution = int(request.args.get("resolution", 60))
+    usage_history = DATASET.uplinks_usage_history(network_id, timespan, resolution)
+    if usage_history is None:
+        return Response(json.dumps({"errors": ["Not found"]}), status=404)
+    return jsonify(usage_history)
+
+
+@app.route("/api/v1/organizations/<organization_id>/appliance/uplinks/usage/byNetwork")
+def get_organization_appliance_uplinks_usage_by_network(organization_id):
+    timespan = int(request.args.get("timespan", 86400))
+    return check_organization(organization_id) or jsonify(
+        DATASET.uplinks_usage_by_network(timespan)
+    )
+
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=9823, debug=True)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=9823)
+    parser.add_argument(
+        "--networks",
+        type=int,
+        default=0,
+        help="Serve a synthetic organization with this many networks instead of the fixtures",
+    )
+    parser.add_argument("--devices", type=int, default=0, help="Devices in the synthetic organization")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic organization")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API request")
+    parser.add_argument(
+        "--rate-limit-probability",
+        type=float,
+        default=0.0,
+        help="Probability of answering an API request with 429 and Retry-After",
+    )
+    parser.add_argument("--page-size", type=int, default=1000, help="Largest page of a paginated endpoint")
+    parser.add_argument(
+        "--fail-networks",
+        type=int,
+        default=0,
+        help="Answer this many network list requests with 500 before serving it",
+    )
+    parser.add_argument(
+        "--drop-uplink-after",
+        type=int,
+        default=0,
+        help="Leave the cellular uplinks out of the uplink statuses after this many requests",
+    )
+    args = parser.parse_args()
+
+    LATENCY = args.latency
+    RATE_LIMIT_PROBABILITY = args.rate_limit_probability
+    PAGE_SIZE = args.page_size
+    FAIL_NETWORKS = args.fail_networks
+    DROP_UPLINK_AFTER = args.drop_uplink_after
+    if args.networks:
+        DATASET = SyntheticDataset(args.networks, max(args.devices, args.networks), args.seed)
+        app.run(host="127.0.0.1", port=args.port, threaded=True)
+    else:
+        app.run(host="127.0.0.1", port=args.port, debug=True)
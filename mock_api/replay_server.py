@@ -0,0 +1,157 @@
+"""Serve Dashboard API responses recorded by the exporter's ``--record`` back to it.
+
+Every request is answered with the next recorded response to the same path
+and query, cycling through them in the order they were recorded, so an
+exporter can be run, profiled and benchmarked against a real organization's
+data without network access. Page links point back at this server. Each
+response is delayed by the time it took when recorded, divided by
+``--speed``; ``--speed 0`` answers straight away.
+
+    python meraki_api_exporter.py -k KEY -o ORG --record recordings/
+    python mock_api/replay_server.py recordings/ --speed 10
+    python meraki_api_exporter.py -k nope -o ORG -m http://127.0.0.1:9823/api/v1
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+
+from flask import Flask, Response, jsonify, request
+
+app = Flask(__name__)
+
+# Recorded responses by path and normalised query, and, for requests whose
+# query differs from the recording's (another timespan, say), first pages by path.
+RESPONSES = defaultdict(list)
+FIRST_PAGES = defaultdict(list)
+ORGANIZATION_IDS = set()
+NEXT = Counter()
+SPEED = 1.0
+CALLS = Counter()
+CALLS_LOCK = threading.Lock()
+CURSORS = {"startingAfter", "endingBefore"}
+LINK = re.compile(r"<([^>]*)>")
+
+
+def normalised(query):
+    return urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(query, keep_blank_values=True)))
+
+
+def read_recording(path):
+    """The responses in one recording, up to where it was cut short if the exporter was killed."""
+    responses = []
+    with gzip.open(path, "rt") as recording:
+        try:
+            for line in recording:
+                responses.append(json.loads(line))
+        except (EOFError, ValueError):
+            pass
+    return responses
+
+
+def load(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith(".jsonl.gz")
+            )
+        else:
+            files = [path]
+        for file in files:
+            for response in read_recording(file):
+                url = urllib.parse.urlsplit(response["url"])
+                RESPONSES[(url.path, normalised(url.query))].append(response)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                if not CURSORS & query.keys():
+                    FIRST_PAGES[url.path].append(response)
+                match = re.search(r"/organizations/([^/]+)", url.path)
+                if match:
+                    ORGANIZATION_IDS.add(match.group(1))
+
+
+def next_response(path, query):
+    key = (path, normalised(query))
+    responses = RESPONSES.get(key)
+    if not responses:
+        if CURSORS & dict(urllib.parse.parse_qsl(query)).keys():
+            return None
+        key = path
+        responses = FIRST_PAGES.get(path)
+        if not responses:
+            return None
+    with CALLS_LOCK:
+        index = NEXT[key] % len(responses)
+        NEXT[key] += 1
+    return responses[index]
+
+
+@app.route("/")
+def root():
+    return "Replaying recorded Dashboard API responses"
+
+
+@app.route("/_stats")
+def stats():
+    with CALLS_LOCK:
+        calls = dict(CALLS)
+    rate_limited = calls.pop("429", 0)
+    return jsonify(
+        {"requests": calls, "total": sum(calls.values()), "rate_limited": rate_limited}
+    )
+
+
+@app.route("/<path:path>")
+def replay(path):
+    with CALLS_LOCK:
+        CALLS[request.path] += 1
+    recorded = next_response(request.path, request.query_string.decode())
+    if recorded is None:
+        if request.path.endswith("/organizations"):
+            # Discovery is not recorded; offer every organization that was.
+            return jsonify(
+                [
+                    {"id": organization_id, "name": organization_id, "api": {"enabled": True}}
+                    for organization_id in sorted(ORGANIZATION_IDS)
+                ]
+            )
+        return Response(json.dumps({"errors": ["Not recorded"]}), status=404)
+
+    if SPEED:
+        time.sleep(recorded["duration"] / SPEED)
+    if recorded["status"] == 429:
+        with CALLS_LOCK:
+            CALLS["429"] += 1
+    headers = dict(recorded["headers"])
+    if "Link" in headers:
+        base = request.host_url.rstrip("/")
+        headers["Link"] = LINK.sub(lambda link: f"<{base}{link.group(1)}>", headers["Link"])
+    return Response(
+        recorded["body"], status=recorded["status"], headers=headers, mimetype="application/json"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recordings", nargs="+", help="Recording files or directories of them")
+    parser.add_argument("--port", type=int, default=9823)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Divide the recorded response times by this, 0 to answer without delay, default 1",
+    )
+    args = parser.parse_args()
+
+    SPEED = args.speed
+    load(args.recordings)
+    print(
+        f"Replaying {sum(map(len, RESPONSES.values()))} responses to {len(RESPONSES)} URLs "
+        f"of organizations {', '.join(sorted(ORGANIZATION_IDS))}",
+        flush=True,
+    )
+    app.run(host="127.0.0.1", port=args.port, threaded=True)
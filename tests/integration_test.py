@@ -1,42 +1,70 @@
+import asyncio
+import gzip
+import os
 import subprocess
+import sys
+import tempfile
 import time
 import unittest
 
 import requests
+from prometheus_client import CollectorRegistry
 from prometheus_client.openmetrics import parser
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from meraki_api_exporter import RateLimiter, UsageCounters  # noqa: E402
 
-class Test(unittest.TestCase):
-    api_exporter = None
-    mock_api = None
+
+def start_exporter(port, *args):
+    """Start an exporter serving its metrics on ``port``, with any other ``args``."""
+    return subprocess.Popen(
+        ["python3", "../meraki_api_exporter.py", "-k", "nope", "-i", "127.0.0.1", "-p", str(port)]
+        + list(args)
+    )
+
+
+def wait_for_metrics(port, expected, timeout=10, path="/"):
+    """The metrics served on ``port`` once they contain ``expected``, or the last served in ``timeout``."""
+    deadline = time.monotonic() + timeout
+    text = ""
+    while time.monotonic() < deadline:
+        try:
+            text = requests.get(f"http://127.0.0.1:{port}{path}").text
+            if expected in text:
+                break
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.2)
+    return text
+
+
+class FeatureTest(unittest.TestCase):
+    """Runs the mock API and an exporter with ``exporter_args`` for the tests of one feature."""
+
+    mock_args = []
+    exporter_port = 9822
+    exporter_args = []
+    organization_args = ["-o", "1234"]
+    metrics_path = "/"
 
     @classmethod
     def setUpClass(cls):
-        # Launching the exporter
-        if not cls.api_exporter:
-            cls.api_exporter = subprocess.Popen(
-                [
-                    "python3",
-                    "../meraki_api_exporter.py",
-                    "-k",
-                    "nope",
-                    "-i",
-                    "127.0.0.1",
-                    "-m",
-                    "http://127.0.0.1:9823/api/v1",
-                    "-o",
-                    "1234"
-                ]
-            )
-
         # Launching the mock dashboard API app
-        if not cls.mock_api:
-            cls.mock_api = subprocess.Popen(["python3", "../mock_api/mock_api.py"])
+        cls.mock_api = subprocess.Popen(["python3", "../mock_api/mock_api.py"] + cls.mock_args)
+
+        # Launching the exporter
+        cls.api_exporter = start_exporter(
+            cls.exporter_port,
+            "-m",
+            "http://127.0.0.1:9823/api/v1",
+            *cls.organization_args,
+            *cls.exporter_args,
+        )
 
         # HACK: Wait for the server to be launched
         while True:
             try:
-                requests.get("http://127.0.0.1:9822/", timeout=0.5)
+                requests.get(f"http://127.0.0.1:{cls.exporter_port}/", timeout=0.5)
                 requests.get("http://127.0.0.1:9823/", timeout=0.5)
                 time.sleep(5)  # Give it a few more seconds for luck
                 break
@@ -49,9 +77,13 @@ class Test(unittest.TestCase):
         cls.api_exporter.terminate()
         cls.mock_api.terminate()
 
+
+class Test(FeatureTest):
+    """Checks that the exporter exports the mock API's fixture, whatever its options."""
+
     def test_get_metrics(self):
         response = requests.get(
-            "http://127.0.0.1:9822/",
+            f"http://127.0.0.1:{self.exporter_port}{self.metrics_path}",
             headers={"accept": "application/openmetrics-text"},
         )
 
@@ -134,3 +166,354 @@ class Test(unittest.TestCase):
 
         # Check all conditional paths are explored
         self.assertEqual(if_count, 12)
+
+    def test_cached_exposition(self):
+        url = f"http://127.0.0.1:{self.exporter_port}{self.metrics_path}"
+        response = requests.get(url, headers={"accept-encoding": "gzip"})
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertIn("meraki_device_status", response.text)
+
+        etag = response.headers["etag"]
+        response = requests.get(
+            url, headers={"accept-encoding": "gzip", "if-none-match": etag}
+        )
+        self.assertEqual(response.status_code, 304)
+
+        response = requests.get(
+            url, headers={"accept-encoding": "identity", "if-none-match": etag}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["etag"], etag)
+
+
+class PerNetworkUsageTest(Test):
+    exporter_port = 9824
+    exporter_args = ["--usage-mode", "per-network"]
+
+    def test_usage_counters(self):
+        response = requests.get(
+            f"http://127.0.0.1:{self.exporter_port}/",
+            headers={"accept": "application/openmetrics-text"},
+        )
+        totals = {
+            (sample.name, sample.labels["uplink"]): sample.value
+            for family in parser.text_string_to_metric_families(response.text)
+            for sample in family.samples
+            if family.name.startswith("meraki_network_uplink_") and family.type == "counter"
+        }
+        self.assertEqual(totals[("meraki_network_uplink_sent_bytes_total", "wan1")], 1111)
+        self.assertEqual(totals[("meraki_network_uplink_received_bytes_total", "cellular")], 4444)
+
+    def test_wireless_network_is_skipped(self):
+        text = wait_for_metrics(self.exporter_port, "meraki_exporter_skipped_requests{")
+        self.assertIn(
+            'meraki_exporter_skipped_requests{endpoint="getNetworkApplianceUplinksUsageHistory"} 1.0',
+            text,
+        )
+        calls = requests.get("http://127.0.0.1:9823/_stats").json()["requests"]
+        self.assertIn("/api/v1/networks/N_24329156/appliance/uplinks/usageHistory", calls)
+        self.assertNotIn("/api/v1/networks/N_83920581/appliance/uplinks/usageHistory", calls)
+
+
+class BuiltinClientTest(PerNetworkUsageTest):
+    exporter_port = 9835
+    exporter_args = ["--usage-mode", "per-network", "--api-client", "builtin"]
+
+
+class MultiOrganizationTest(Test):
+    exporter_port = 9825
+    organization_args = []
+    metrics_path = "/?target=1234"
+
+    def test_organizations(self):
+        response = requests.get(f"http://127.0.0.1:{self.exporter_port}/organizations")
+        self.assertEqual(
+            response.text,
+            '- targets:\n    - "1234"\n  labels:\n    organizationName: "My organization"\n',
+        )
+
+    def test_unknown_target(self):
+        response = requests.get(f"http://127.0.0.1:{self.exporter_port}/?target=5678")
+        self.assertEqual(response.status_code, 404)
+
+
+class ScrapeDrivenTest(Test):
+    exporter_port = 9826
+    exporter_args = ["--scrape-ttl", "5", "--devices-interval", "1"]
+
+    def snapshot_timestamp(self):
+        response = requests.get(
+            f"http://127.0.0.1:{self.exporter_port}/",
+            headers={"accept": "application/openmetrics-text"},
+        )
+        for family in parser.text_string_to_metric_families(response.text):
+            if family.name == "meraki_exporter_snapshot_timestamp_seconds":
+                return family.samples[0].value
+
+    def test_scrape_refreshes_stale_metrics(self):
+        first = self.snapshot_timestamp()
+        time.sleep(6)
+        self.assertGreater(self.snapshot_timestamp(), first)
+
+
+class WarmRestartTest(FeatureTest):
+    exporter_port = 9827
+    state_dir = tempfile.mkdtemp()
+    exporter_args = ["--state-dir", state_dir]
+
+    def test_restart_serves_saved_metrics(self):
+        # A second exporter that cannot reach the API serves what the first one saved.
+        self.assertIn(
+            "meraki_device_status{", wait_for_metrics(self.exporter_port, "meraki_device_status{")
+        )
+        restarted = start_exporter(
+            9828, "-m", "http://127.0.0.1:9/api/v1", "-o", "1234", "--state-dir", self.state_dir
+        )
+        try:
+            text = wait_for_metrics(9828, "meraki_device_status{")
+            self.assertIn('meraki_device_status{deviceName="My AP"', text)
+        finally:
+            restarted.terminate()
+
+    def test_restart_serves_saved_organizations(self):
+        # Without -o, saved organizations are served before they can be listed.
+        self.assertIn(
+            "meraki_device_status{", wait_for_metrics(self.exporter_port, "meraki_device_status{")
+        )
+        restarted = start_exporter(
+            9842, "-m", "http://127.0.0.1:9/api/v1", "--state-dir", self.state_dir
+        )
+        try:
+            text = wait_for_metrics(9842, "meraki_device_status{", path="/?target=1234")
+            self.assertIn('meraki_device_status{deviceName="My AP"', text)
+        finally:
+            restarted.terminate()
+
+
+class RecordReplayTest(FeatureTest):
+    exporter_port = 9836
+    record_dir = tempfile.mkdtemp()
+    exporter_args = ["--record", record_dir, "--record-anonymised"]
+
+    def test_replay_recording(self):
+        # An exporter collecting from the replayed recording exports what this one does, anonymised.
+        wait_for_metrics(self.exporter_port, "meraki_device_uplink_latency{")
+        replay_server = subprocess.Popen(
+            ["python3", "../mock_api/replay_server.py", self.record_dir, "--port", "9837"]
+        )
+        replayed = None
+        try:
+            for _ in range(50):
+                try:
+                    organizations = requests.get("http://127.0.0.1:9837/api/v1/organizations")
+                    break
+                except requests.exceptions.ConnectionError:
+                    time.sleep(0.2)
+            organization_id = organizations.json()[0]["id"]
+            self.assertNotEqual(organization_id, "1234")
+            replayed = start_exporter(
+                9838, "-m", "http://127.0.0.1:9837/api/v1", "-o", organization_id
+            )
+            text = wait_for_metrics(9838, "meraki_device_uplink_latency{")
+            self.assertIn("meraki_device_status{", text)
+            self.assertIn("} 0.19490000000000002", text)
+            self.assertNotIn("My AP", text)
+            self.assertNotIn("Q234-ABCD-5678", text)
+
+            # The recording is still being written, so it is read up to its last flush.
+            recorded = []
+            for name in os.listdir(self.record_dir):
+                with gzip.open(os.path.join(self.record_dir, name), "rt") as recording:
+                    try:
+                        recorded.extend(recording)
+                    except EOFError:
+                        pass
+            recorded = "".join(recorded)
+            self.assertIn("/networks", recorded)
+            for identifier in ("Q234-ABCD-5678", "N_24329156", "my-enrollment-string", "123456789"):
+                self.assertNotIn(identifier, recorded)
+        finally:
+            replay_server.terminate()
+            if replayed is not None:
+                replayed.terminate()
+
+
+class ShardTest(FeatureTest):
+    exporter_port = 9829
+    # N_24329156 hashes to shard 1 of 2.
+    exporter_args = ["--shard-count", "2", "--shard-index", "1"]
+
+    def test_other_shard_exports_nothing(self):
+        self.assertIn(
+            "meraki_device_status{", wait_for_metrics(self.exporter_port, "meraki_device_status{")
+        )
+        other = start_exporter(
+            9830,
+            "-m",
+            "http://127.0.0.1:9823/api/v1",
+            "-o",
+            "1234",
+            "--shard-count",
+            "2",
+            "--shard-index",
+            "0",
+        )
+        try:
+            text = wait_for_metrics(9830, 'last_success_timestamp_seconds{source="uplink_usage"}')
+            self.assertIn('source="uplink_usage"', text)
+            self.assertNotIn("meraki_device_status{", text)
+            self.assertNotIn("meraki_network_uplink_sent{", text)
+        finally:
+            other.terminate()
+
+
+class LossAndLatencyWindowTest(FeatureTest):
+    exporter_port = 9831
+    exporter_args = ["--loss-latency-window", "300", "--loss-latency-timestamps"]
+
+    def test_window_statistics_and_timestamps(self):
+        response = requests.get(
+            f"http://127.0.0.1:{self.exporter_port}/",
+            headers={"accept": "application/openmetrics-text"},
+        )
+        samples = {
+            (sample.name, sample.labels["uplink"], sample.labels.get("stat")): sample
+            for family in parser.text_string_to_metric_families(response.text)
+            for sample in family.samples
+            if sample.name.startswith("meraki_device_uplink_l")
+        }
+        # A single sample in the window, so every statistic is that sample.
+        for stat in ("min", "max", "mean", "p95"):
+            self.assertAlmostEqual(
+                samples[("meraki_device_uplink_latency_window", "wan1", stat)].value, 0.1949
+            )
+            self.assertEqual(samples[("meraki_device_uplink_loss_window", "cellular", stat)].value, 1.2)
+        self.assertEqual(
+            samples[("meraki_device_uplink_latency", "wan1", None)].timestamp.sec, 1548960373
+        )
+
+
+class CircuitBreakerTest(FeatureTest):
+    exporter_port = 9834
+    # An API that never answers in time.
+    exporter_args = [
+        "-m", "http://127.0.0.1:9/api/v1", "--devices-interval", "1", "--source-timeout", "0.5"
+    ]
+
+    def test_failing_source_opens_circuit(self):
+        text = wait_for_metrics(
+            self.exporter_port, 'meraki_exporter_source_circuit_open{source="devices"} 1.0', 25
+        )
+        self.assertIn('meraki_exporter_source_circuit_open{source="devices"} 1.0', text)
+        self.assertIn('meraki_exporter_source_timeouts_total{source="devices"}', text)
+        self.assertNotIn("meraki_device_status{", text)
+        # Nothing was ever collected, so the snapshot never advanced.
+        self.assertIn("meraki_exporter_snapshot_timestamp_seconds 0.0", text)
+
+
+class DebugEndpointTest(FeatureTest):
+    exporter_port = 9839
+    exporter_args = ["--debug-endpoint", "--devices-interval", "1"]
+
+    def test_profile(self):
+        response = requests.get(f"http://127.0.0.1:{self.exporter_port}/debug/profile?cycles=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("(update_metrics)", response.text)
+
+    def test_memory(self):
+        response = requests.get(f"http://127.0.0.1:{self.exporter_port}/debug/memory?limit=5")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Top 5 changes since then:", response.text)
+
+    def test_series(self):
+        response = requests.get(f"http://127.0.0.1:{self.exporter_port}/debug/series")
+        self.assertEqual(response.json()["meraki_device_status"], 1)
+        self.assertEqual(response.json()["meraki_device_uplink_latency"], 2)
+
+
+class FailedRefreshTest(FeatureTest):
+    # Enough 500s for the first two refreshes of the hourly network list to fail.
+    mock_args = ["--fail-networks", "6"]
+    exporter_port = 9841
+
+    def test_failed_source_is_retried_before_its_interval(self):
+        text = wait_for_metrics(self.exporter_port, "meraki_device_status{", 60)
+        self.assertIn('meraki_exporter_source_failures_total{source="networks"}', text)
+        self.assertIn('meraki_device_status{deviceName="My AP"', text)
+
+
+class SeriesEvictionTest(FeatureTest):
+    # The cellular uplink disappears from the uplink statuses after a few refreshes.
+    mock_args = ["--drop-uplink-after", "3"]
+    exporter_port = 9843
+    exporter_args = ["--uplink-statuses-interval", "1", "--series-ttl", "3"]
+
+    def test_stale_series_is_evicted(self):
+        evicted = 'meraki_exporter_series_evicted_total{metric="meraki_device_uplink_status"}'
+        text = wait_for_metrics(self.exporter_port, evicted, 30)
+        self.assertIn(evicted, text)
+        statuses = [
+            line for line in text.splitlines() if line.startswith("meraki_device_uplink_status{")
+        ]
+        self.assertTrue(any('uplink="wan1"' in line for line in statuses))
+        self.assertFalse(any('uplink="cellular"' in line for line in statuses))
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_priority_order(self):
+        async def grant_order():
+            limiter = RateLimiter(20, CollectorRegistry(), capacity=1)
+            await limiter.acquire("other", 0)
+            granted = []
+
+            async def request(priority):
+                await limiter.acquire("other", priority)
+                granted.append(priority)
+
+            await asyncio.gather(*(request(priority) for priority in (3, 1, 2, 1)))
+            return granted
+
+        self.assertEqual(asyncio.run(grant_order()), [1, 1, 2, 3])
+
+    def test_retry_after_pauses_every_request(self):
+        async def time_requests():
+            limiter = RateLimiter(5, CollectorRegistry())
+            start = time.monotonic()
+            limiter.throttled("other", "0.5")
+            # No tokens accrue during the pause, so three requests need 0.6 s more.
+            await asyncio.gather(*(limiter.acquire("other", 0) for _ in range(3)))
+            return time.monotonic() - start
+
+        elapsed = asyncio.run(time_requests())
+        self.assertGreaterEqual(elapsed, 1.05)
+        self.assertLess(elapsed, 2)
+
+
+class UsageCountersTest(unittest.TestCase):
+    def test_prune_forgets_networks_no_longer_planned(self):
+        counters = UsageCounters()
+        bucket = {
+            "startTime": "2019-01-31T18:45:00Z",
+            "endTime": "2019-01-31T18:46:00Z",
+            "byInterface": [{"interface": "wan1", "sent": "1", "received": "2"}],
+        }
+        counters.add("N_1", [bucket])
+        counters.add("N_2", [bucket])
+        counters.prune(["N_2", "N_3"])
+        self.assertEqual(counters.totals, {"N_2": {"wan1": [1.0, 2.0]}})
+        self.assertEqual(list(counters.counted_until), ["N_2"])
+
+
+class RateLimitedApiTest(FeatureTest):
+    mock_args = ["--rate-limit-probability", "0.3"]
+    exporter_port = 9840
+    exporter_args = ["--devices-interval", "1"]
+
+    def test_throttled_requests_are_retried(self):
+        text = wait_for_metrics(
+            self.exporter_port, "meraki_exporter_api_throttled_requests_total{", 30
+        )
+        self.assertIn("meraki_exporter_api_throttled_requests_total{", text)
+        text = wait_for_metrics(self.exporter_port, "meraki_device_status{", 30)
+        self.assertIn('meraki_device_status{deviceName="My AP"', text)
+        self.assertIn("meraki_exporter_api_rate_limit_wait_seconds_total{", text)